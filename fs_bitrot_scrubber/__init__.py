@@ -1,5 +1,11 @@
 #-*- coding: utf-8 -*-
 
+try: from os import scandir
+except ImportError:
+	try: from scandir import scandir # python2 backport module
+	except ImportError: scandir = None
+
+
 def force_unicode(bytes_or_unicode, encoding='utf-8', errors='replace'):
 	if isinstance(bytes_or_unicode, unicode): return bytes_or_unicode
 	return bytes_or_unicode.decode(encoding, errors)
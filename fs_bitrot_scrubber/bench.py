@@ -0,0 +1,241 @@
+#-*- coding: utf-8 -*-
+
+import itertools as it, operator as op
+from os.path import join, exists
+from time import time
+import os, re, random, resource, logging
+
+from fs_bitrot_scrubber.db import MetaDB
+from fs_bitrot_scrubber.parity import DBParity
+from fs_bitrot_scrubber.fadvise import fadvise
+from fs_bitrot_scrubber.pathfilter import PathFilter
+
+
+phases_all = ['walk', 'scan', 'queue', 'hash', 'parity']
+
+# Metrics where lower value is better, others (rates) are higher-is-better
+metrics_lower = ['time', 'rss_mb']
+
+
+def parse_size(size):
+	'Returns number of bytes for size string like "4k", "1.5M" or "100".'
+	m = re.search(r'^\s*([\d.]+(?:e\d+)?)\s*([kmgt]?)i?b?\s*$', bytes(size), re.I)
+	if not m: raise ValueError('Invalid size value: {!r}'.format(size))
+	return int(float(m.group(1)) * 2**(10 * ' kmgt'.index(m.group(2).lower() or ' ')))
+
+def parse_size_dist(spec):
+	'Returns list of (size, weight) tuples for "size[:weight] ..." spec, e.g. "4k:70 1M:25 32M:5".'
+	dist = list()
+	for v in spec.split() if isinstance(spec, basestring) else spec:
+		size, weight = v.split(':', 1) if ':' in v else (v, 1)
+		dist.append((parse_size(size), float(weight)))
+	if not dist or sum(it.imap(op.itemgetter(1), dist)) <= 0:
+		raise ValueError('Invalid file size distribution: {!r}'.format(spec))
+	return dist
+
+
+def make_tree( path, files=1000, size_dist=[(4096, 1)],
+		depth=2, fanout=4, sparse=0, hardlinks=0, seed=None ):
+	'''Create synthetic tree of files under path and return number of bytes in these.
+		size_dist - list of (size, weight) tuples, with actual sizes picked in 0.5-1.5x of these.
+		depth/fanout - levels of directories and number of subdirs on each level.
+		sparse - fraction of sparse files (with only few data blocks written),
+			hardlinks - fraction of files to create as hardlinks to other ones.'''
+	rng = random.Random(seed)
+	dirs = ['']
+	for level in xrange(depth):
+		dirs = list(join(p, 'dir_{:03d}'.format(n)) for p in dirs for n in xrange(fanout))
+	for p in dirs: os.makedirs(join(path, p))
+	data = os.urandom(2**20)
+	sizes, weights = zip(*size_dist)
+	weights_sum, total, created = sum(weights), 0, list()
+	for n in xrange(files):
+		p = join(path, rng.choice(dirs), 'file_{:06d}'.format(n))
+		if created and rng.random() < hardlinks:
+			os.link(rng.choice(created), p)
+			continue
+		w = rng.random() * weights_sum
+		for size, weight in size_dist:
+			w -= weight
+			if w <= 0: break
+		size = int(size * (0.5 + rng.random()))
+		with open(p, 'wb') as dst:
+			if size > 3 * 4096 and rng.random() < sparse:
+				for offset in 0, size // 2, size - 4096:
+					dst.seek(offset)
+					dst.write(data[:4096])
+			else:
+				pos = rng.randrange(len(data))
+				while size > 0:
+					chunk = data[pos:pos + size]
+					dst.write(chunk)
+					size -= len(chunk)
+					pos = 0
+			dst.truncate()
+		total += os.stat(p).st_size
+		created.append(p)
+	return total
+
+
+class BenchPhase(object):
+	'Accumulates counters and timing for one benchmark phase.'
+
+	def __init__(self, name, meta_db=None):
+		self.name, self.meta_db = name, meta_db
+		self.files = self.bytes = 0
+		self.queries = meta_db.query_count if meta_db else 0
+		self.ts = time()
+
+	def done(self):
+		self.time = max(time() - self.ts, 1e-6)
+		if self.meta_db: self.queries = self.meta_db.query_count - self.queries
+		return dict(
+			files=self.files, bytes=self.bytes, queries=self.queries, time=self.time,
+			files_s=self.files / self.time, mb_s=self.bytes / self.time / 1e6,
+			queries_s=self.queries / self.time,
+			rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 )
+
+
+def run( path, file_list, meta_db_kwz=None, phases=None,
+		checksum=None, bs=4 * 2**20, parity_opts=None, drop_caches=False, log=None ):
+	'''Run benchmark phases on the tree under path and return {phase: results}.
+		file_list - function to walk the tree, same as core.file_list.
+		Metadata db is created under path as well, and is removed afterwards.
+		Peak RSS values are for the whole process, up to the end of each phase.'''
+	log = log or logging.getLogger('bitrot_scrubber.bench')
+	phases, results = phases or phases_all, dict()
+	db_path = join(path, 'bench.sqlite')
+	for p in db_path, db_path + '.check':
+		if exists(p): os.unlink(p)
+	root = join(path, 'tree')
+
+	phase = BenchPhase('walk')
+	paths = list()
+	for p, fstat in file_list([root]):
+		paths.append((p, fstat))
+		phase.files, phase.bytes = phase.files + 1, phase.bytes + fstat.st_size
+	if 'walk' in phases: results['walk'] = phase.done()
+
+	meta_db = MetaDB(db_path, checksum=checksum, **(meta_db_kwz or dict()))
+	try:
+		def _scan():
+			meta_db.set_generation(new=True)
+			for p, fstat in paths:
+				meta_db.metadata_check( p, size=fstat.st_size,
+					mtime=fstat.st_mtime, ctime=fstat.st_ctime, dev=fstat.st_dev,
+					ino=fstat.st_ino, nlink=fstat.st_nlink )
+			meta_db.metadata_clean()
+
+		phase = BenchPhase('scan', meta_db)
+		_scan()
+		phase.files = len(paths)
+		if 'scan' in phases: results['scan'] = phase.done()
+
+		if 'queue' in phases:
+			phase = BenchPhase('queue', meta_db)
+			while True:
+				node = meta_db.get_file_to_scrub()
+				if not node: break
+				node.close()
+				node.q('UPDATE state SET clean = 1 WHERE file_id = ?', (node.meta['id'],))
+				phase.files += 1
+			results['queue'] = phase.done()
+			_scan() # new generation with all files to check again
+
+		if 'hash' in phases:
+			if drop_caches:
+				for p, fstat in paths:
+					with open(p, 'rb') as src: fadvise(src, drop_cache=True)
+			phase = BenchPhase('hash', meta_db)
+			while True:
+				node = meta_db.get_file_to_scrub()
+				if not node: break
+				while True:
+					bs_read = node.read(bs)
+					if not bs_read: break
+					phase.bytes += bs_read
+				node.close()
+				phase.files += 1
+			results['hash'] = phase.done()
+	finally: meta_db.close()
+
+	if 'parity' in phases:
+		parity_opts = dict(parity_opts or dict())
+		for k in 'verify_on_open', 'wal_max_size': parity_opts.pop(k, None)
+		phase = BenchPhase('parity')
+		with DBParity(db_path + '.check', db_path, log=log, **parity_opts) as db_parity:
+			db_parity.update()
+			db_parity.verify()
+		phase.bytes = os.stat(db_path).st_size * 2 # read on update and verify
+		results['parity'] = phase.done()
+
+	for p in db_path, db_path + '.check':
+		if exists(p): os.unlink(p)
+	return results
+
+
+def compare(results, baseline, threshold=10.0):
+	'''Returns list of (phase, metric, value, value_baseline, change_percent, is_regression)
+		for all metrics present in both results, where regressions are worse than threshold (%).'''
+	res = list()
+	for phase in phases_all:
+		if phase not in results or phase not in baseline: continue
+		for k in ['time', 'files_s', 'mb_s', 'queries_s', 'rss_mb']:
+			val, val_base = results[phase].get(k), baseline[phase].get(k)
+			if not val_base or val is None: continue
+			change = (val - val_base) * 100.0 / val_base
+			worse = -change if k not in metrics_lower else change
+			res.append((phase, k, val, val_base, change, worse > threshold))
+	return res
+
+
+def check_filters_loop(path, filters, default=True):
+	'Reference implementation of "storage.filter" rules, checking each one in order.'
+	for include, pat in filters:
+		if re.search(pat, path): return include
+	return default
+
+def make_filter_rules(count=200, dirs=100, seed=None):
+	'''Returns list of (include, pattern) rules, similar to ones in "storage.filter" config,
+		with most of these anchored to directory prefixes, and the rest matching names/extensions.'''
+	rng, rules = random.Random(seed), list()
+	exts = ['mp3', 'ogg', 'iso', 'tmp', 'bak', 'log', 'o', 'pyc', 'part', 'swp']
+	for n in xrange(count):
+		k, d = rng.random(), 'dir_{:03d}'.format(rng.randrange(dirs))
+		if k < 0.6:
+			pat = '^/srv/{}/'.format(d)
+			if rng.random() < 0.5: pat += 'sub_{:02d}/'.format(rng.randrange(10))
+		elif k < 0.8: pat = r'\.({})$'.format('|'.join(rng.sample(exts, 2)))
+		elif k < 0.9: pat = r'/(cache|tmp)_{:03d}/'.format(rng.randrange(dirs))
+		else: pat = r'^/srv/{}/.*backup-\d+'.format(d)
+		rules.append((rng.random() < 0.3, pat))
+	return rules
+
+def make_filter_paths(count=100000, dirs=100, seed=None):
+	'Returns list of paths for rules from make_filter_rules(), incl. directories with trailing slash.'
+	rng, paths = random.Random(seed), list()
+	exts = ['mp3', 'ogg', 'iso', 'jpg', 'txt', 'bak', 'log', 'py', 'pyc', 'dat']
+	for n in xrange(count):
+		p = '/srv/dir_{:03d}/sub_{:02d}/'.format(rng.randrange(dirs), rng.randrange(10))
+		if rng.random() < 0.1: p += '{}_{:03d}/'.format(rng.choice(['cache', 'tmp']), rng.randrange(dirs))
+		if rng.random() < 0.1: p += 'backup-{}/'.format(rng.randrange(100))
+		if rng.random() < 0.8: p += 'file_{:06d}.{}'.format(n, rng.choice(exts))
+		paths.append(p)
+	return paths
+
+def filter_bench(rules, paths):
+	'''Returns dict with rates (paths/s) of checking paths against rules in a loop ("loop"),
+		and via compiled PathFilter ("compiled"), its compilation time and number of
+		paths with different results ("mismatches"), which should always be zero.'''
+	res, rules = dict(), list((include, re.compile(pat)) for include, pat in rules)
+	ts = time()
+	path_filter = PathFilter(rules)
+	res['compile_time'] = time() - ts
+	ts = time()
+	results = list(check_filters_loop(p, rules) for p in paths)
+	res['loop'] = len(paths) / max(time() - ts, 1e-6)
+	ts = time()
+	results_compiled = list(it.imap(path_filter, paths))
+	res['compiled'] = len(paths) / max(time() - ts, 1e-6)
+	res['mismatches'] = sum(it.imap(op.ne, results, results_compiled))
+	return res
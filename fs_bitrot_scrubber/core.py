@@ -6,31 +6,52 @@ import itertools as it, operator as op, functools as ft
 from os.path import realpath, join, isdir, dirname, basename, exists
 from contextlib import contextmanager
 from time import time, sleep
-import os, sys, re, hashlib, stat, types, logging
+from datetime import datetime
+import os, sys, re, json, zlib, hashlib, stat, types, logging, threading, Queue
 
 
-try: from fs_bitrot_scrubber import db, force_unicode
+try: from fs_bitrot_scrubber import db, hashes, force_unicode, scandir
 except ImportError:
 	# Make sure it works from a checkout
 	if isdir(join(dirname(__file__), 'fs_bitrot_scrubber'))\
 			and exists(join(dirname(__file__), 'setup.py')):
 		sys.path.insert(0, dirname(__file__))
-	from fs_bitrot_scrubber import db, force_unicode
+	from fs_bitrot_scrubber import db, hashes, force_unicode, scandir
+from fs_bitrot_scrubber.fiemap import first_extent
+from fs_bitrot_scrubber.pathfilter import PathFilter
+from fs_bitrot_scrubber import fswatch, parity, throttle, bench, metrics
 
 
 is_str = lambda obj,s=types.StringTypes: isinstance(obj, s)
 
-_re_type = type(re.compile(''))
+_filters_cache, _filters_cache_max = dict(), 20
 
 def check_filters(path, filters, default=True):
-	for rule in filters:
-		try: x, pat = rule
-		except (TypeError, ValueError): x, pat = False, rule
-		if not isinstance(pat, _re_type): pat = re.compile(pat)
-		if pat.search(path): return x
-	return default
+	'''Returns whether path is included by the list of (include, regexp) filters, see PathFilter.
+		Filters are compiled into PathFilter on first call and cached, but it's more
+			efficient to compile these once and use resulting PathFilter directly instead.'''
+	if isinstance(filters, PathFilter): return filters(path)
+	key = tuple(filters or list()), default
+	try: path_filter = _filters_cache[key]
+	except KeyError:
+		if len(_filters_cache) >= _filters_cache_max: _filters_cache.clear()
+		path_filter = _filters_cache[key] = PathFilter(filters, default)
+	except TypeError: path_filter = PathFilter(filters, default) # unhashable rules, e.g. lists
+	return path_filter(path)
 
-def token_bucket(metric, spec):
+def check_shard(path, shard):
+	'Returns whether path belongs to (n, count) shard, as picked by stable hash of the path.'
+	n, count = shard
+	return (zlib.crc32(path) & 0xffffffff) % count == n
+
+def parse_duration(val):
+	'Returns number of seconds for duration string like "90", "30m", "4h" or "1.5d".'
+	m = re.search(r'^\s*([\d.]+(?:e\d+)?)\s*([smhd]?)\s*$', bytes(val), re.I)
+	if not m: raise ValueError('Invalid duration value: {!r}'.format(val))
+	return float(m.group(1)) * dict(s=1, m=60, h=3600, d=86400)[m.group(2).lower() or 's']
+
+def token_bucket_spec(metric, spec):
+	'Returns (interval, burst) tuple for "interval[:burst]" rate limit spec.'
 	try:
 		try: interval, burst = spec.rsplit(':', 1)
 		except (ValueError, AttributeError): interval, burst = spec, 1.0
@@ -42,7 +63,10 @@ def token_bucket(metric, spec):
 		if min(interval, burst) < 0: raise ValueError()
 	except:
 		raise ValueError('Invalid format for rate limit (metric: {}): {!r}'.format(metric, spec))
+	return interval, burst
 
+def token_bucket(metric, spec):
+	interval, burst = token_bucket_spec(metric, spec)
 	tokens, rate, ts_sync = burst, interval**-1, time()
 	val = yield
 	while True:
@@ -52,50 +76,428 @@ def token_bucket(metric, spec):
 			if tokens >= val else ((val - tokens) / rate, tokens - val)
 		val = yield val
 
+def token_bucket_init(metric, spec):
+	bucket = token_bucket(metric, spec)
+	next(bucket)
+	return bucket
+
+def rate_limit_init(metric, spec, disk=None):
+	'''Returns token_bucket generator for "interval[:burst]" spec string,
+			or throttle.AdaptiveBucket for a dict with adaptive rate limit parameters.
+		"disk" is a name of the device for per-device limits, if known.'''
+	if not isinstance(spec, dict): return token_bucket_init(metric, spec)
+	spec = dict(spec)
+	try:
+		rate_min, rate_max = (token_bucket_spec(metric, spec.pop(k))[0]**-1 for k in ['min', 'max'])
+	except KeyError:
+		raise ValueError('Both "min" and "max" must be set for adaptive rate limit (metric: {})'.format(metric))
+	if disk is not None: disk = [disk]
+	try:
+		spec = dict((k, float(v) if v is not None else None) for k, v in spec.viewitems()) # e.g. "1e6" in yaml
+		return throttle.AdaptiveBucket(metric, rate_min, rate_max, disks=disk, **spec)
+	except (TypeError, ValueError) as err:
+		raise ValueError('Invalid adaptive rate limit parameters (metric: {}): {}'.format(metric, err))
+
+
+
+def _file_list_dir(path, dev, xdev, roots, check_filters, log):
+	'''Returns a tuple of subdirectories (path, dev) to descend into
+		and a list of (path, stat) tuples for regular files in a directory path.
+		Uses scandir (when available) to skip non-file/dir entries without stat() calls.'''
+	dirs, files = list(), list()
+	try: entries = iter(scandir(path) if scandir else os.listdir(path))
+	except (OSError, IOError):
+		log.info(force_unicode('Failed to list directory: {}'.format(path)))
+		return dirs, files
+
+	while True:
+		# scandir reads directory lazily, so errors (e.g. EIO) can be raised here as well
+		try: entry = next(entries)
+		except StopIteration: break
+		except (OSError, IOError):
+			log.info(force_unicode('Failed to list directory: {}'.format(path)))
+			break
+		if scandir:
+			p = entry.path
+			try:
+				is_dir = entry.is_dir(follow_symlinks=False) # these use d_type, if possible
+				if not is_dir and not entry.is_file(follow_symlinks=False): continue
+				if not check_filters(p if not is_dir else p + '/'): continue
+				fstat = entry.stat(follow_symlinks=False)
+			except (IOError, OSError): # entry vanished
+				log.info(force_unicode('Failed to stat path: {}'.format(p)))
+				continue
+		else:
+			p = join(path, entry)
+			try: fstat = os.lstat(p)
+			except (IOError, OSError):
+				log.info(force_unicode('Failed to stat path: {}'.format(p)))
+				continue
+			is_dir = stat.S_ISDIR(fstat.st_mode)
+			if not is_dir and not stat.S_ISREG(fstat.st_mode): continue
+			if not check_filters(p if not is_dir else p + '/'): continue
+
+		if not is_dir: files.append((p, fstat))
+		elif p in roots: continue # will be processed separately
+		elif xdev and fstat.st_dev != dev:
+			log.info(force_unicode('Skipping mountpoint: {}'.format(p)))
+		else: dirs.append((p, dev))
+
+	return dirs, files
 
+def _file_list_worker(tasks, results, log, **list_kwz):
+	while True:
+		task = tasks.get()
+		if task is None: break
+		try: results.put((True, _file_list_dir(*task, log=log, **list_kwz)))
+		except Exception as err:
+			log.exception(force_unicode('Failed to process directory: {}'.format(task[0])))
+			results.put((False, err))
 
-def file_list(paths, xdev=True, path_filter=list()):
-	_check_filters = ft.partial(check_filters, filters=path_filter)
-	paths = set(it.imap(realpath, paths))
+def file_list(paths, xdev=True, path_filter=list(), threads=1):
+	'''Generator of (path, stat) tuples for all regular files in specified paths.
+		path_filter - PathFilter or a list of rules for it, with excluded directories not descended into.
+		With threads > 1, independent directories are listed
+			from a pool of threads, so that many metadata requests are in-flight at once.'''
+	if not isinstance(path_filter, PathFilter): path_filter = PathFilter(path_filter)
 	log = logging.getLogger('bitrot_scrubber.walk')
 
-	while paths:
-		path_base = paths.pop()
-		try: path_base_dev = os.stat(path_base).st_dev
+	roots = dict()
+	for path_base in set(it.imap(realpath, paths)):
+		try: roots[path_base] = os.stat(path_base).st_dev
 		except (OSError, IOError):
 			log.info(force_unicode('Unable to access scrub-path: {}'.format(path_base)))
-			continue
+	list_kwz = dict(xdev=xdev, roots=roots, check_filters=path_filter)
+	dirs = roots.items()
 
-		for p, dirs, files in os.walk(path_base, topdown=True):
-			if xdev and p not in paths and os.stat(p).st_dev != path_base_dev:
-				log.info(force_unicode('Skipping mountpoint: {}'.format(p)))
-				while dirs: dirs.pop() # don't descend into anything here
-				continue
-			paths.discard(p)
-
-			i_off = 0
-			for i, name in list(enumerate(dirs)):
-				path = join(p, name)
-				# Filtered-out dirs won't be descended into
-				if not _check_filters(path + '/'):
-					del dirs[i - i_off]
-					i_off += 1 # original list just became shorter
-
-			for name in files:
-				path = join(p, name)
-				if not _check_filters(path): continue
-				try: fstat = os.lstat(path)
-				except (IOError, OSError): # file vanished
-					log.info(force_unicode('Failed to stat path: {}'.format(path)))
-					continue
-				if not stat.S_ISREG(fstat.st_mode): continue
-				yield path, fstat
+	if threads <= 1:
+		while dirs:
+			dirs_sub, files = _file_list_dir(*dirs.pop(), log=log, **list_kwz)
+			dirs.extend(dirs_sub)
+			for path, fstat in files: yield path, fstat
+		return
+
+	tasks, results = Queue.Queue(), Queue.Queue()
+	workers = list()
+	for n in xrange(threads):
+		worker = threading.Thread( target=_file_list_worker,
+			args=(tasks, results, log), kwargs=list_kwz, name='walk-worker-{}'.format(n) )
+		worker.daemon = True
+		worker.start()
+		workers.append(worker)
+	try:
+		in_flight, in_flight_max = 0, threads * 2
+		while dirs or in_flight:
+			while dirs and in_flight < in_flight_max:
+				tasks.put(dirs.pop()) # LIFO (depth-first) to keep dirs list short
+				in_flight += 1
+			try: success, res = results.get(timeout=1.0)
+			except Queue.Empty: continue
+			in_flight -= 1
+			if not success: raise res
+			dirs_sub, files = res
+			dirs.extend(dirs_sub)
+			for path, fstat in files: yield path, fstat
+	finally:
+		for worker in workers: tasks.put(None)
+		for worker in workers: worker.join()
+
+
+def dev_disk(dev):
+	'''Returns name of the whole-disk block device (e.g. "sda") for st_dev value,
+		as resolved via /sys, or "major:minor" string if it's not a block device there.'''
+	dev_id = '{}:{}'.format(os.major(dev), os.minor(dev))
+	path = realpath('/sys/dev/block/{}'.format(dev_id))
+	if not exists(path): return dev_id # e.g. nfs, tmpfs, btrfs subvolumes
+	if exists(join(path, 'partition')): path = dirname(path)
+	return basename(path)
+
+
+class ScrubLane(object):
+	'Queue of nodes and workers for files on one device (or on all of them).'
+
+	def __init__(self, name, devs=None, read_limit=None):
+		self.name, self.devs, self.read_limit = name, devs, read_limit
+		self.lock, self.nodes, self.workers = threading.Lock(), Queue.Queue(), list()
+		self.busy = self.files = self.bytes = 0 # only updated from the pool thread
+		self.stats_ts, self.stats_bytes = time(), 0
+
+class ScrubPool(object):
+	'''Pool of threads to read/hash files picked from MetaDB.
+		All db updates from workers are passed back to and done from the thread calling run().
+		With per_device=True, files are grouped by underlying disk
+			into "lanes", each with its own set of workers and rate limit (if any).
+		budget - ScrubBudget, after which no new files are queued, and
+			reads in progress are aborted at its deadline, if any.'''
+
+	poll_interval = 1.0 # Queue.get() without timeout can't be interrupted in py2
+	devs_interval = 60.0 # interval between checks for new devices in queue
+
+	def __init__( self, meta_db, workers, bs=4 * 2**20, skip_for=3 * 3600,
+			read_limit=None, per_device=False, read_limit_device=None,
+			progress_interval=None, budget=None ):
+		self.meta_db, self.bs, self.skip_for, self.budget = meta_db, bs, skip_for, budget
+		self.metrics = meta_db.metrics
+		self.read_limit, self.read_limit_lock = read_limit, threading.Lock()
+		self.read_limit_device = read_limit_device
+		self.worker_count, self.per_device = workers, per_device
+		self.results, self.stop = Queue.Queue(), threading.Event()
+		self.busy = set() # paths of nodes handed over to workers
+		self.log = logging.getLogger('bitrot_scrubber.pool')
+		self.progress_interval, self.progress_ts = progress_interval, time()
+
+		self.lanes, self.devs, self.devs_ts = dict(), set(), 0
+		if not per_device: self._lane_add(None)
+
+	def _lane_add(self, name, devs=None):
+		lane = self.lanes[name] = ScrubLane( name, devs,
+			read_limit=self.read_limit_device(disk=name) if self.read_limit_device else None )
+		for n in xrange(self.worker_count):
+			worker = threading.Thread( target=self._worker, args=(lane,),
+				name='scrub-worker-{}-{}'.format(name or 'any', n) )
+			worker.daemon = True
+			worker.start()
+			lane.workers.append(worker)
+		if name: self.log.debug('Added scrub queue for device: {}'.format(name))
+		return lane
+
+	def _lanes_update(self, force=False):
+		'Returns True if any new devices were found.'
+		ts = time()
+		if not self.per_device or (not force and ts - self.devs_ts < self.devs_interval): return
+		self.devs_ts, devs = ts, self.meta_db.get_scrub_devs().difference(self.devs)
+		for dev in devs:
+			name = dev_disk(dev) if dev is not None else 'unknown'
+			lane = self.lanes.get(name) or self._lane_add(name, list())
+			lane.devs.append(dev)
+		self.devs.update(devs)
+		return bool(devs)
+
+	def _worker(self, lane):
+		while True:
+			node = lane.nodes.get()
+			if node is None: break
+			path, deadline, done = node.meta['path'], self.budget and self.budget.deadline, True
+			try:
+				try:
+					while True:
+						if self.stop.is_set() or (deadline and time() >= deadline):
+							done = False # aborted, node is closed without storing any results
+							break
+						bs_read = node.read(self.bs)
+						if bs_read: self.results.put(('read', lane.name, path, bs_read))
+						# Global bucket is shared, so that it applies to combined rate of all workers
+						for read_limit, lock in [
+								(self.read_limit, self.read_limit_lock), (lane.read_limit, lane.lock) ]:
+							if not read_limit: continue
+							with lock: delay = read_limit.send(bs_read)
+							if delay and deadline: delay = min(delay, deadline - time())
+							if delay: self.metrics.sleep('sleep_read', delay, interrupt=self.stop)
+						if not bs_read: break
+				except (IOError, OSError) as err: node.read_failed(err)
+				finally: node.close()
+			except Exception as err:
+				self.log.exception(force_unicode('Failed to process file: {}'.format(path)))
+				self.results.put(('error', err))
+			self.results.put(('done', lane.name, path, done))
+
+	def _queue_node(self, lane, node):
+		query = node.q
+		path = node.meta['path']
+		node.q = lambda *argz, **kwz: self.results.put(('query', path, query, argz, kwz))
+		self.busy.add(path)
+		lane.busy += 1
+		lane.nodes.put(node)
+
+	def _process_result(self, result):
+		res, data = result[0], result[1:]
+		if res == 'query':
+			path, query, argz, kwz = data
+			query(*argz, **kwz)
+		elif res == 'read':
+			self.lanes[data[0]].bytes += data[2]
+			if self.budget: self.budget.add(data[2])
+		elif res == 'done':
+			lane = self.lanes[data[0]]
+			lane.busy -= 1
+			lane.files += data[2]
+			self.busy.discard(data[1])
+		elif res == 'error': raise data[0]
+		else: raise ValueError(result)
+
+	def log_progress(self, force=False):
+		ts = time()
+		if not force and (not self.progress_interval\
+			or ts - self.progress_ts < self.progress_interval): return
+		for name, lane in sorted(self.lanes.viewitems()):
+			delta_bytes, delta_ts = lane.bytes - lane.stats_bytes, ts - lane.stats_ts
+			self.log.info('Progress (device: {}): {} files, {:.1f} MiB checked ({:.1f} MiB/s)'.format(
+				name or 'any', lane.files, lane.bytes / 2.0**20, delta_bytes / 2.0**20 / max(delta_ts, 1e-3) ))
+			lane.stats_ts, lane.stats_bytes = ts, lane.bytes
+		self.progress_ts = ts
+
+	def run(self, deadline=None):
+		'''Keep all workers busy and apply db updates from these
+				until deadline (unix time) or until there are no more files to check.
+			Returns False in the latter case, True otherwise.'''
+		while True:
+			self._lanes_update()
+			for lane in self.lanes.viewvalues():
+				while lane.busy < len(lane.workers):
+					if self.budget and self.budget.spent(): break
+					node = self.meta_db.get_file_to_scrub(
+						skip_for=self.skip_for, exclude=self.busy, devs=lane.devs )
+					if not node: break
+					self._queue_node(lane, node)
+			self.log_progress()
+			self.metrics.export()
+			self.meta_db.lease_renew()
+			if not self.busy:
+				if self._lanes_update(force=True): continue # files on new devices
+				return False
+			timeout = self.poll_interval
+			if deadline is not None:
+				timeout = min(timeout, deadline - time())
+				if timeout <= 0: return True
+			try: result = self.results.get(timeout=timeout)
+			except Queue.Empty: continue
+			self._process_result(result)
+
+	def close(self):
+		# Files in progress on all lanes are abandoned, so that slow disks don't delay shutdown
+		self.stop.set()
+		for lane in self.lanes.viewvalues():
+			for worker in lane.workers: lane.nodes.put(None)
+		for lane in self.lanes.viewvalues():
+			for worker in lane.workers: worker.join()
+			lane.workers = list()
+		pending = dict() # path -> results, applied only if node was processed before interruption
+		while True:
+			try: result = self.results.get_nowait()
+			except Queue.Empty: break
+			if result[0] in ['query', 'read']:
+				pending.setdefault(result[1 if result[0] == 'query' else 2], list()).append(result)
+			elif result[0] == 'done':
+				results = pending.pop(result[2], list())
+				if result[3]:
+					for res in results + [result]: self._process_result(res)
+		if self.per_device: self.log_progress(force=True)
+
+
+class ScrubBudget(object):
+	'''Limits on time and/or data read in one scrub run, and estimates/reports based on these.
+		Time limit is a hard deadline counted from the start of the run (incl. scan, which
+			is always finished), at which reads of any files in progress are aborted.
+		After reaching bytes limit, already started files are finished, but no new ones are picked.
+		Read throughput of each run is stored in metadata db, to estimate how much
+			can be checked within time limit, and SLA compliance of the next runs.'''
+
+	throughput_min_time = 1.0 # min seconds of checking files to measure throughput over
+
+	def __init__(self, time_limit=None, bytes_limit=None):
+		self.ts_start = time()
+		self.time_limit, self.bytes_limit = time_limit, bytes_limit
+		self.deadline = self.ts_start + time_limit if time_limit else None
+		self.bytes, self.bytes_check, self.ts_check = 0, 0, None
+		self.log = logging.getLogger('bitrot_scrubber.budget')
+
+	def add(self, bytes_read): self.bytes += bytes_read
+
+	def spent(self):
+		'Returns True when no more files should be picked for checking.'
+		if self.bytes_limit and self.bytes >= self.bytes_limit: return True
+		return bool(self.deadline and time() >= self.deadline)
+
+	def throughput(self, meta_db):
+		'Returns bytes/s measured in this run, or stored from previous ones, if any.'
+		if self.ts_check:
+			delta = time() - self.ts_check
+			if delta >= self.throughput_min_time and self.bytes > self.bytes_check:
+				return (self.bytes - self.bytes_check) / delta
+		val = meta_db.get_meta('scrub_throughput')
+		return float(val) if val else None
+
+	def capacity(self, meta_db):
+		'Returns max number of bytes that can be checked in a run, or None if not limited.'
+		limits = list()
+		if self.bytes_limit: limits.append(self.bytes_limit)
+		if self.time_limit:
+			rate = self.throughput(meta_db)
+			if rate: limits.append(self.time_limit * rate)
+		return min(limits) if limits else None
+
+	def check_start(self, meta_db):
+		'Mark start of checking files (after scan), logging estimate for it.'
+		self.ts_check, self.bytes_check = time(), self.bytes
+		files, size = map(sum, zip(*meta_db.get_queue_stats().viewvalues()))
+		rate, msg = self.throughput(meta_db), ''
+		if rate:
+			msg += ', estimated time: {:.0f}s at {:.1f} MiB/s'.format(size / rate, rate / 2.0**20)
+			if self.deadline:
+				limit = max(0, self.deadline - time()) * rate
+				if self.bytes_limit: limit = min(limit, self.bytes_limit)
+				msg += ', ~{:.1f} MiB fits into budget'.format(limit / 2.0**20)
+		self.log.info('Files to check: {}, {:.1f} MiB{}'.format(files, size / 2.0**20, msg))
+
+	def report(self, meta_db):
+		'''Logs summary of the run and projected compliance with SLA max age
+				of the files, assuming that next runs will be started at the same interval.
+			Stores measured throughput and start time of the run in metadata db.
+			Returns {max_age: stats} from MetaDB.get_sla_stats() with "ok" flag added to each.'''
+		rate = self.ts_check and self.throughput(meta_db)
+		if rate and time() - self.ts_check >= self.throughput_min_time:
+			rate_old = meta_db.get_meta('scrub_throughput')
+			if rate_old: rate = (rate + float(rate_old)) / 2 # smooth-out single-run spikes
+			meta_db.set_meta('scrub_throughput', repr(rate))
+		ts_last = meta_db.get_meta('scrub_ts_start')
+		meta_db.set_meta('scrub_ts_start', repr(self.ts_start))
+		interval, interval_info = 86400.0, 'assumed daily'
+		if ts_last and float(ts_last) < self.ts_start:
+			interval = self.ts_start - float(ts_last)
+			interval_info = 'measured {:.1f}h'.format(interval / 3600)
+
+		files, size = map(sum, zip(*meta_db.get_queue_stats().viewvalues()))
+		self.log.info( 'Checked {:.1f} MiB in {:.0f}s, files left unchecked: {} ({:.1f} MiB)'.format(
+			self.bytes / 2.0**20, time() - self.ts_start, files, size / 2.0**20 ))
+		# Files with deadline before the start of the run after next one must be checked
+		#  in the next run, and all classes share same budget, so are checked together here,
+		#  along with average rate needed to keep all files within their max age
+		capacity = self.capacity(meta_db)
+		sla = meta_db.get_sla_stats(time(), self.ts_start + 2 * interval)
+		due = sum(stats['due_bytes'] for stats in sla.viewvalues())
+		rate_total = sum(stats['rate'] for stats in sla.viewvalues())
+		budget_ok = capacity is None or max(due, rate_total * interval) <= capacity
+		for max_age, stats in sorted(sla.viewitems()):
+			stats['ok'] = budget_ok and not stats['overdue_files'] and interval <= max_age
+			(self.log.info if stats['ok'] else self.log.warning)(
+				( 'SLA (max age: {:.1f}d){}: {} files ({:.1f} MiB), {} overdue ({:.1f} MiB),'
+					' {} due by the next run ({:.1f} MiB), needs {:.1f} MiB/day' ).format(
+				max_age / 86400, '' if stats['ok'] else ' at risk', stats['files'],
+				stats['bytes'] / 2.0**20, stats['overdue_files'], stats['overdue_bytes'] / 2.0**20,
+				stats['due_files'], stats['due_bytes'] / 2.0**20, stats['rate'] * 86400 / 2.0**20 ))
+		if sla:
+			self.log.info( 'SLA projection: budget {} per run,'
+				' run interval: {}, needs {:.1f} MiB/run, {:.1f} MiB due by the next run'.format(
+					'{:.1f} MiB'.format(capacity / 2.0**20) if capacity is not None else 'not limited',
+					interval_info, rate_total * interval / 2.0**20, due / 2.0**20 ))
+		return sla
 
 
 def scrub( paths, meta_db,
 		xdev=True, path_filter=list(), scan_only=False, resume=False,
-		skip_for=3 * 3600, bs=4 * 2**20, rate_limits=None ):
+		skip_for=3 * 3600, bs=4 * 2**20, rate_limits=None,
+		workers=1, per_device=False, progress_interval=None,
+		scan_threads=1, scan_extents=False, shard=None, budget=None ):
+	'''Scan and/or check files in specified paths.
+		rate_limits can have "scan" and "read" token_bucket generators,
+			and "read_device" - callable to create such generator for each device (per_device=True).
+		scan_extents - lookup physical offset of the first
+			extent for each file during scan, for "extent" scrub order in MetaDB.
+		shard - (n, count) tuple to only scan files in n-th of count shards, see check_shard().
+		budget - ScrubBudget to limit time/bytes spent on checking files.
+		Time spent in each phase is counted in meta_db.metrics, which are exported periodically.'''
 	log = logging.getLogger('bitrot_scrubber.scrub')
+	stats = meta_db.metrics
 
 	meta_db.set_generation(new=not resume)
 	log.info('Scrub generation number: {}'.format(meta_db.generation))
@@ -105,65 +507,172 @@ def scrub( paths, meta_db,
 	ts_scan = ts_read = 0 # deadline for the next iteration
 
 	file_node = None # currently scrubbed (checksummed) file
+	pool = None if scan_only or (workers <= 1 and not per_device) else ScrubPool(
+		meta_db, workers, bs=bs, skip_for=skip_for, read_limit=read_limit,
+		per_device=per_device, read_limit_device=getattr(rate_limits, 'read_device', None),
+		progress_interval=progress_interval, budget=budget )
 
-	if not resume:
-		## Scan
-		for path, fstat in file_list(paths, xdev=xdev, path_filter=path_filter):
-			log.debug(force_unicode('Scanning path: {}'.format(path)))
-			# Bumps generaton number on path as well, to facilitate cleanup
-			meta_db.metadata_check( path,
-				size=fstat.st_size, mtime=fstat.st_mtime, ctime=fstat.st_ctime )
-
-			# Scan always comes first, unless hits the limit
-			if not scan_limit: continue
-			ts, delay = time(), scan_limit.send(1)
-			if not delay: continue
-			ts_scan = ts + delay
-
-			while True:
-				if ts >= ts_scan: break # get back to scan asap
-
-				if not scan_only and not file_node: # pick next node
-					file_node = meta_db.get_file_to_scrub(skip_for=skip_for)
-				if ts_scan < ts_read or not file_node:
-					delay = ts_scan - ts
-					if delay > 0:
-						# log.debug('Rate-limiting delay (scan): {:.1f}s'.format(delay))
-						sleep(delay)
-					break
-
-				bs_read = file_node.read(bs)
-				if not bs_read: # done with this one
-					file_node.close()
-					file_node = None
+	try:
+		if not resume:
+			## Scan
+			for path, fstat in stats.timed_iter('walk', file_list( paths,
+					xdev=xdev, path_filter=path_filter, threads=scan_threads )):
+				if shard and not check_shard(path, shard): continue
+				log.debug(force_unicode('Scanning path: {}'.format(path)))
+				# Bumps generaton number on path as well, to facilitate cleanup
 				ts = time()
+				meta_db.metadata_check( path, size=fstat.st_size,
+					mtime=fstat.st_mtime, ctime=fstat.st_ctime, dev=fstat.st_dev,
+					ino=fstat.st_ino, nlink=fstat.st_nlink,
+					extent=first_extent(path) if scan_extents else None )
+				stats.add_time('scan', time() - ts)
+				stats.add('files_scanned')
+				stats.export()
+
+				# Scan always comes first, unless hits the limit
+				if not scan_limit: continue
+				ts, delay = time(), scan_limit.send(1)
+				if not delay: continue
+				ts_scan = ts + delay
 
-				if read_limit:
-					delay = read_limit.send(bs_read)
-					if delay:
-						ts_read = ts + delay
-						if ts_read < ts_scan:
-							# log.debug('Rate-limiting delay (read): {:.1f}s'.format(delay))
-							sleep(delay)
-							ts = time()
+				if pool: # workers are rate-limited by themselves
+					if not pool.run(deadline=ts_scan): stats.sleep('sleep_scan', ts_scan - time())
+					continue
 
-		## Drop all meta-nodes for files with old generation
-		meta_db.metadata_clean()
-		if scan_only: return
+				while True:
+					if ts >= ts_scan: break # get back to scan asap
 
-	## Check the rest of non-clean files in this gen
-	while True:
-		if not file_node: file_node = meta_db.get_file_to_scrub(skip_for=skip_for)
-		if not file_node: break
-		bs_read = file_node.read(bs)
-		if not bs_read:
-			file_node.close()
-			file_node = None
-		if read_limit:
-			delay = read_limit.send(bs_read)
-			if delay:
-				# log.debug('Rate-limiting delay (read): {:.1f}s'.format(delay))
-				sleep(delay)
+					if not scan_only and not file_node\
+							and not (budget and budget.spent()): # pick next node
+						file_node = meta_db.get_file_to_scrub(skip_for=skip_for)
+					if ts_scan < ts_read or not file_node:
+						# log.debug('Rate-limiting delay (scan): {:.1f}s'.format(ts_scan - ts))
+						stats.sleep('sleep_scan', ts_scan - ts)
+						break
+
+					try: bs_read = file_node.read(bs)
+					except (IOError, OSError) as err:
+						file_node.read_failed(err)
+						bs_read = 0
+					ts = time()
+					if budget: budget.add(bs_read)
+					if not bs_read or (budget and budget.deadline and ts >= budget.deadline):
+						file_node.close() # done with this one or out of time
+						file_node = None
+
+					if read_limit:
+						delay = read_limit.send(bs_read)
+						if delay:
+							ts_read = ts + delay
+							if ts_read < ts_scan:
+								# log.debug('Rate-limiting delay (read): {:.1f}s'.format(delay))
+								stats.sleep('sleep_read', delay)
+								ts = time()
+
+			## Drop all meta-nodes for files with old generation
+			with stats.timer('clean'): meta_db.metadata_clean()
+			if scan_only: return
+
+		## Check the rest of non-clean files in this gen
+		if budget: budget.check_start(meta_db)
+		if pool:
+			pool.run()
+			return
+		while True:
+			if not file_node:
+				if budget and budget.spent(): break
+				file_node = meta_db.get_file_to_scrub(skip_for=skip_for)
+			if not file_node: break
+			try: bs_read = file_node.read(bs)
+			except (IOError, OSError) as err:
+				file_node.read_failed(err)
+				bs_read = 0
+			if budget: budget.add(bs_read)
+			if not bs_read or (budget and budget.deadline and time() >= budget.deadline):
+				file_node.close()
+				file_node = None
+			if read_limit:
+				delay = read_limit.send(bs_read)
+				if delay:
+					# log.debug('Rate-limiting delay (read): {:.1f}s'.format(delay))
+					if budget and budget.deadline: delay = min(delay, budget.deadline - time())
+					stats.sleep('sleep_read', delay)
+			stats.export()
+			meta_db.lease_renew()
+
+	finally:
+		if pool: pool.close()
+
+
+def watch( paths, meta_db, xdev=True, path_filter=list(),
+		backend='auto', reconcile_interval=None, reconcile=False, settle_delay=30, **scrub_kwz ):
+	'''Run continuously, picking up file changes from fs events and checking these,
+			with full scrub (scan and check of all files) every reconcile_interval seconds,
+			to pick up any changes that were missed by fs event watchers.
+		reconcile - run full scrub on start, regardless of when it was last done.
+		Extra keywords are passed to scrub().'''
+	log = logging.getLogger('bitrot_scrubber.watch')
+	if not isinstance(path_filter, PathFilter): path_filter = PathFilter(path_filter)
+	scan_extents, shard = scrub_kwz.get('scan_extents'), scrub_kwz.get('shard')
+
+	watcher = fswatch.watcher(paths, xdev=xdev, check_filters=path_filter, backend=backend)
+	log.debug('Using fs watcher: {}'.format(type(watcher).__name__))
+	try:
+		ts_reconcile = meta_db.get_meta('watch_reconcile_ts')
+		if ts_reconcile is None or reconcile: ts_reconcile = 0
+		elif reconcile_interval: ts_reconcile = float(ts_reconcile) + reconcile_interval
+		else: ts_reconcile = None
+		meta_db.set_generation(new=False)
+		check = True # files left unchecked from the last run
+
+		while True:
+			if ts_reconcile is not None and time() >= ts_reconcile:
+				log.info('Running full scrub to pick up all changes since the last one')
+				scrub(paths, meta_db, xdev=xdev, path_filter=path_filter, **scrub_kwz)
+				meta_db.set_meta('watch_reconcile_ts', time())
+				ts_reconcile = (time() + reconcile_interval) if reconcile_interval else None
+				check = False
+
+			paths_changed, overflow = watcher.get_changes(settle_delay)
+			if overflow:
+				log.warning('Some fs events were missed, scheduling full scrub to pick these up')
+				ts_reconcile = time() + settle_delay
+			paths_removed = list()
+			for path in paths_changed:
+				root = watcher.root(path)
+				if not root: continue
+				path_dir = dirname(path)
+				while path_dir != root and path_dir.startswith(root):
+					if not path_filter(path_dir + '/'): break
+					path_dir = dirname(path_dir)
+				else:
+					if not path_filter(path): continue
+					if shard and not check_shard(path, shard): continue
+					try: fstat = os.lstat(path)
+					except (OSError, IOError): fstat = None
+					if not fstat or not stat.S_ISREG(fstat.st_mode):
+						paths_removed.append(path)
+						continue
+					if xdev and fstat.st_dev != watcher.roots[root]: continue
+					log.debug(force_unicode('Updating changed path: {}'.format(path)))
+					meta_db.metadata_check( path, size=fstat.st_size,
+						mtime=fstat.st_mtime, ctime=fstat.st_ctime, dev=fstat.st_dev,
+						ino=fstat.st_ino, nlink=fstat.st_nlink,
+						extent=first_extent(path) if scan_extents else None )
+					check = True
+			meta_db.metadata_flush()
+			# Dropped after new paths are added, so that moved files can be matched to these
+			for path in paths_removed:
+				log.debug(force_unicode('Dropping removed path: {}'.format(path)))
+				meta_db.drop_file(path)
+			meta_db.metrics.export()
+
+			if check:
+				scrub(paths, meta_db, resume=True, **scrub_kwz)
+				check = False
+			else: sleep(min(settle_delay, 10) or 1)
+
+	finally: watcher.close()
 
 
 
@@ -197,10 +706,71 @@ def main(argv=None):
 		cmd.add_argument('-r', '--resume', action='store_true',
 			help='Dont scan any paths, but rather resume scrubbing from the point'
 				' where the last run was interrupted. Mutually exclusive with --scan-only.')
+		cmd.add_argument('-t', '--time-budget', metavar='duration',
+			help='Max duration of the run (e.g. "4h", "30m" or seconds),'
+				' after which checking files is stopped, leaving the rest for the next run.'
+				' Overrides "operation.budget.time" config value.')
+		cmd.add_argument('-b', '--byte-budget', metavar='size',
+			help='Max amount of data (e.g. "500G") to read from files in one run,'
+				' after which no new files are checked. Overrides "operation.budget.bytes" config value.')
 		cmd.add_argument('-p', '--extra-paths', nargs='+', metavar='path',
 			help='Extra paths to append to the one(s) configured via "storage.path".'
 				' Can be used to set the list of paths dynamically (e.g., via wildcard from shell).')
 
+	with subcommand('watch', help='Run continuously, checking files as these change'
+			' (according to fs events from fanotify/inotify), with periodic full scrub runs,'
+			' to pick up any changes that were missed. See "operation.watch" config section.') as cmd:
+		cmd.add_argument('-r', '--reconcile', action='store_true',
+			help='Run full scrub on start, regardless of when it was last done.')
+		cmd.add_argument('-p', '--extra-paths', nargs='+', metavar='path',
+			help='Extra paths to append to the one(s) configured via "storage.path".')
+
+	with subcommand('bench', help='Generate synthetic tree of files in a temporary'
+			' directory and measure performance of each scrub phase on it, using current configuration.') as cmd:
+		cmd.add_argument('-n', '--files', type=int, metavar='n', default=2000,
+			help='Number of files to create (default: %(default)s).')
+		cmd.add_argument('-s', '--sizes', metavar='size[:weight] ...', default='4k:70 256k:25 16M:5',
+			help='Space-separated distribution of file sizes with relative weights,'
+				' where actual sizes are picked randomly in 0.5x-1.5x range of these (default: %(default)s).')
+		cmd.add_argument('-d', '--depth', type=int, metavar='n', default=3,
+			help='Levels of directories in generated tree (default: %(default)s).')
+		cmd.add_argument('-w', '--fanout', type=int, metavar='n', default=4,
+			help='Number of subdirectories on each level (default: %(default)s).')
+		cmd.add_argument('--sparse', type=float, metavar='fraction', default=0,
+			help='Fraction of files (0-1.0) to create as sparse ones (default: %(default)s).')
+		cmd.add_argument('--hardlinks', type=float, metavar='fraction', default=0,
+			help='Fraction of files (0-1.0) to create as hardlinks to other ones (default: %(default)s).')
+		cmd.add_argument('--seed', type=int, metavar='n', default=0,
+			help='Seed for random generator, so that same tree is produced on each run (default: %(default)s).')
+		cmd.add_argument('-p', '--path', metavar='path',
+			help='Directory to create tree and db in. It will be reused (not generated)'
+				' if it has "tree" subdir already, and is not removed afterwards. Default is a temp dir.')
+		cmd.add_argument('--phases', metavar='phase,...', default=','.join(bench.phases_all),
+			help='Comma-separated list of phases to run (default: %(default)s).')
+		cmd.add_argument('-c', '--drop-caches', action='store_true',
+			help='Drop generated files from page cache (via fadvise) before hashing them.')
+		cmd.add_argument('--save', metavar='path',
+			help='Save results as a JSON baseline to specified file.')
+		cmd.add_argument('--compare', metavar='path',
+			help='Compare results with JSON baseline from specified file,'
+				' exiting with non-zero code if there are regressions above --threshold.')
+		cmd.add_argument('-t', '--threshold', type=float, metavar='percent', default=10,
+			help='Change in metric value to consider a regression, in %% (default: %(default)s).')
+
+	with subcommand('db-verify', help='Check whole metadata db file against stored'
+			' parity data (see "storage.metadata.db_parity"), repairing it if possible.'
+			' Exits with code 2 if any corruption was found (even if repaired),'
+			' or 1 if it cannot be repaired.') as cmd:
+		cmd.add_argument('-n', '--dry-run', action='store_true',
+			help='Only check db file and parity data, without repairing anything.')
+
+	with subcommand('db-merge', help='Merge info on files from other metadata db(s)'
+			' into configured one, e.g. after checking different shards of files on multiple hosts'
+			' (see "operation.shard" option). Files present in both are updated, if these were'
+			' checked more recently in the other db, and all merged ones get current generation.') as cmd:
+		cmd.add_argument('paths', nargs='+', metavar='db_path',
+			help='Path(s) to other metadata db(s) to merge into configured one.')
+
 	with subcommand('status', help='List files with status recorded in the database.') as cmd:
 		cmd.add_argument('-v', '--verbose', action='store_true',
 			help='Display last check and modification info along with the path.')
@@ -210,9 +780,37 @@ def main(argv=None):
 			help='Only list files which were checked on the last run.')
 		cmd.add_argument('-u', '--not-checked', action='store_true',
 			help='Only list files which were left unchecked on the last run.')
+		cmd.add_argument('-p', '--prefix', metavar='path',
+			help='Only list files with paths starting with specified prefix,'
+				' e.g. directory (with trailing slash) or start of the file name.')
+		cmd.add_argument('-n', '--limit', type=int, metavar='n',
+			help='Only list first n files matching other filters.')
+		cmd.add_argument('-s', '--summary', action='store_true',
+			help='Print number and size of files in each state (total, checked, not checked,'
+				' new, dirty, skipped), instead of listing them. Only --prefix filter applies here.')
+		cmd.add_argument('-j', '--json', action='store_true',
+			help='Print info for each file as a JSON object on a separate line (JSON-lines),'
+				' or single JSON object with --summary, instead of human-readable output.')
 		# cmd.add_argument('-n', '--new', action='store_true',
 		# 	help='Files that are not yet recorded at all, but exist on disk. Implies fs scan.')
 
+	with subcommand('bench-hash', help='Measure hashing speed'
+			' of all available hash algorithms (or specified ones) on this host.') as cmd:
+		cmd.add_argument('names', nargs='*',
+			help='Names of hash algorithms to check (default: all known available ones).')
+		cmd.add_argument('-s', '--size', type=float, metavar='MiB', default=256,
+			help='Amount of data to hash with each algorithm, in MiB (default: %(default)s).')
+
+	with subcommand('bench-filter', help='Measure speed of checking paths against'
+			' "storage.filter" rules (or synthetic ones), compiled into matcher vs checking each one.') as cmd:
+		cmd.add_argument('-n', '--rules', type=int, metavar='n', default=200,
+			help='Number of synthetic rules to generate, if none'
+				' are configured in "storage.filter" (default: %(default)s).')
+		cmd.add_argument('-p', '--paths', type=int, metavar='n', default=200000,
+			help='Number of synthetic paths to check (default: %(default)s).')
+		cmd.add_argument('--seed', type=int, metavar='n', default=0,
+			help='Seed for random generator of rules/paths (default: %(default)s).')
+
 	optz = parser.parse_args(sys.argv[1:] if argv is None else argv)
 
 	## Read configuration files
@@ -224,35 +822,200 @@ def main(argv=None):
 		logging.WARNING if not optz.debug else logging.DEBUG )
 	log = logging.getLogger('bitrot_scrubber.root')
 
+	if optz.call == 'bench-hash':
+		names = optz.names or hashes.available()
+		data = os.urandom(int(cfg.operation.read_block))
+		for name in names:
+			try: checksum = hashes.get(name)
+			except LookupError:
+				print('{}: not available'.format(name))
+				continue
+			rate = hashes.bench(checksum, data, optz.size * 2**20)
+			print('{}: {:.1f} MB/s'.format(name, rate / 1e6))
+		return
+
+	if optz.call == 'bench-filter':
+		_filter_actions = {'+': True, '-': False}
+		rules = list((_filter_actions[pat[0]], pat[1:]) for pat in (cfg.storage.filter or list()))\
+			or bench.make_filter_rules(optz.rules, seed=optz.seed)
+		paths = bench.make_filter_paths(optz.paths, seed=optz.seed)
+		res = bench.filter_bench(rules, paths)
+		print('{} rules, {} paths'.format(len(rules), len(paths)))
+		print('loop: {:.0f} paths/s'.format(res['loop']))
+		print('compiled: {:.0f} paths/s ({:.1f}x), compiled in {:.1f}ms'.format(
+			res['compiled'], res['compiled'] / res['loop'], res['compile_time'] * 1000 ))
+		if res['mismatches']:
+			print('ERROR: different results for {} path(s)'.format(res['mismatches']))
+			return 1
+		return
+
 	## Options processing
-	if not cfg.storage.metadata.db:
+	if not cfg.storage.metadata.db and optz.call != 'bench':
 		parser.error('Path to metadata db ("storage.metadata.db") must be configured.')
-	try: cfg.operation.checksum = getattr(hashlib, cfg.operation.checksum)
-	except AttributeError: cfg.operation.checksum = hashlib.new(cfg.operation.checksum)
+	try: hashes.get(cfg.operation.checksum)
+	except LookupError as err: parser.error(str(err))
 	if is_str(cfg.storage.path): cfg.storage.path = [cfg.storage.path]
 	else: cfg.storage.path = list(cfg.storage.path or list())
 	_filter_actions = {'+': True, '-': False}
-	cfg.storage.filter = list(
+	cfg.storage.filter = PathFilter(list(
 		(_filter_actions[pat[0]], re.compile(pat[1:]))
-		for pat in (cfg.storage.filter or list()) )
+		for pat in (cfg.storage.filter or list()) ))
 	for metric, spec in cfg.operation.rate_limit.viewitems():
 		if not spec: continue
-		spec = token_bucket(metric, spec)
-		next(spec)
-		cfg.operation.rate_limit[metric] = spec
-	if cfg.storage.metadata.db_parity is None:
+		bucket = ft.partial(rate_limit_init, metric, spec)
+		cfg.operation.rate_limit[metric] = bucket()\
+			if not metric.endswith('_device') else bucket # separate one for each device
+	if cfg.storage.metadata.db_parity is None and cfg.storage.metadata.db:
 		cfg.storage.metadata.db_parity = cfg.storage.metadata.db + '.check'
 	skip_for = cfg.operation.skip_for_hours * 3600
 	cfg.operation.read_block = int(cfg.operation.read_block)
+	change_check = cfg.operation.change_check or 'chunk'
+	try:
+		mode, val = change_check.split(':', 1) if ':' in change_check else (change_check, None)
+		if mode in ['bytes', 'seconds']: val = float(val)
+		elif mode not in ['chunk', 'inotify', 'eof'] or val is not None: raise ValueError(mode)
+	except (TypeError, ValueError):
+		parser.error('Invalid "operation.change_check" value: {!r}'.format(change_check))
+	change_check = mode, val
+	if cfg.operation.read_engine not in ['buffered', 'readinto', 'direct']:
+		parser.error('Unknown "operation.read_engine" value: {!r}'.format(cfg.operation.read_engine))
+	shard = cfg.operation.shard
+	if shard:
+		try:
+			shard = tuple(int(v) for v in bytes(shard).split('/', 1))
+			if len(shard) != 2 or not 0 <= shard[0] < shard[1]: raise ValueError(shard)
+		except ValueError:
+			parser.error('Invalid "operation.shard" value: {!r}'.format(cfg.operation.shard))
+	lease = cfg.storage.metadata.lease
+	lease = (lease.time, lease.owner) if lease.time else None
+	if lease and cfg.storage.metadata.db_parity is not False:
+		parser.error( 'Parity data for metadata db can only be updated by one process,'
+			' so "storage.metadata.db_parity" must be set to "false" with leases enabled.' )
+	sla = list()
+	try:
+		for spec in cfg.operation.sla.classes or list():
+			days, regexp = bytes(spec).split(None, 1)
+			if float(days) <= 0: raise ValueError(days)
+			sla.append((re.compile(regexp), float(days) * 86400))
+	except (ValueError, re.error):
+		parser.error('Invalid "operation.sla.classes" value: {!r}'.format(spec))
+	if cfg.operation.sla.max_age_days: sla.append((None, float(cfg.operation.sla.max_age_days) * 86400))
+	block_map = None
+	if cfg.operation.block_map.block_size:
+		block_map = tuple(int(cfg.operation.block_map[k] or 0) for k in ['block_size', 'min_file_size'])
+
+	scrub_kwz = dict(
+		xdev=cfg.storage.xdev, path_filter=cfg.storage.filter,
+		skip_for=skip_for, bs=cfg.operation.read_block,
+		rate_limits=cfg.operation.rate_limit, workers=cfg.operation.workers,
+		per_device=cfg.operation.per_device,
+		progress_interval=cfg.operation.progress_interval,
+		scan_threads=cfg.storage.scan_threads,
+		scan_extents=cfg.operation.scrub_order == 'extent', shard=shard )
+
+	parity_opts = dict(cfg.storage.metadata.db_parity_options or dict())
+	meta_db_kwz = dict(
+		log_queries=cfg.logging.sql_queries,
+		use_fadvise=cfg.operation.use_fadvise,
+		scan_batch=cfg.storage.metadata.scan_batch,
+		scrub_order=cfg.operation.scrub_order,
+		queue_batch=cfg.storage.metadata.queue_batch,
+		block_map=block_map, read_engine=cfg.operation.read_engine,
+		read_pipeline=cfg.operation.read_pipeline, change_check=change_check,
+		sqlite_opts=cfg.storage.metadata.sqlite,
+		checksum_xattr=cfg.operation.checksum_xattr,
+		sparse_files=cfg.operation.sparse_files, sla=sla,
+		commit_after=op.itemgetter('queries', 'seconds')\
+			(cfg.storage.metadata.db_commit_after) )
 
 	## Actual work
 	log.debug('Starting (operation: {})'.format(optz.call))
+
+	if optz.call == 'bench':
+		import tempfile, shutil
+		phases = optz.phases.split(',')
+		for phase in phases:
+			if phase not in bench.phases_all: parser.error('Unknown bench phase: {!r}'.format(phase))
+		try: size_dist = bench.parse_size_dist(optz.sizes)
+		except ValueError as err: parser.error(str(err))
+		path = optz.path or tempfile.mkdtemp(prefix='fs-bitrot-scrubber-bench.')
+		try:
+			if not exists(join(path, 'tree')):
+				log.debug('Generating tree of {} files in: {}'.format(optz.files, path))
+				size = bench.make_tree( join(path, 'tree'), optz.files, size_dist,
+					depth=optz.depth, fanout=optz.fanout, sparse=optz.sparse,
+					hardlinks=optz.hardlinks, seed=optz.seed )
+				log.debug('Generated {:.1f} MiB of data'.format(size / 2.0**20))
+			results = bench.run( path,
+				ft.partial(file_list, xdev=cfg.storage.xdev, threads=cfg.storage.scan_threads),
+				meta_db_kwz, phases, checksum=cfg.operation.checksum,
+				bs=cfg.operation.read_block, parity_opts=parity_opts,
+				drop_caches=optz.drop_caches, log=log )
+		finally:
+			if not optz.path: shutil.rmtree(path)
+		for phase in bench.phases_all:
+			if phase not in results: continue
+			print( ( '{0}: {1[files]} files, {1[bytes]} B in {1[time]:.2f}s - {1[files_s]:.1f} files/s,'
+				' {1[mb_s]:.1f} MB/s, {1[queries]} db queries ({1[queries_s]:.1f}/s),'
+				' peak rss: {1[rss_mb]:.1f} MiB' ).format(phase, results[phase]) )
+		if optz.save:
+			with open(optz.save, 'w') as dst: json.dump(results, dst, indent=2, sort_keys=True)
+		if optz.compare:
+			with open(optz.compare) as src: baseline = json.load(src)
+			regressions = 0
+			for phase, k, val, val_base, change, worse in\
+					bench.compare(results, baseline, optz.threshold):
+				print('{}{} {}: {:.2f} -> {:.2f} ({:+.1f}%)'.format(
+					'REGRESSION: ' if worse else '', phase, k, val_base, val, change ))
+				regressions += worse
+			if regressions: return 1
+		return
+
+	if optz.call == 'db-verify':
+		db_path, db_parity = cfg.storage.metadata.db, cfg.storage.metadata.db_parity
+		if not db_parity:
+			parser.error('Path to parity data ("storage.metadata.db_parity") must be configured.')
+		if not exists(db_parity):
+			parser.error('Parity data file does not exist: {}'.format(db_parity))
+		if not parity.DBParity.is_parity_db(db_parity):
+			parser.error( 'Parity data file is in old format,'
+				' it will be converted on the next run of any other command.' )
+		for k in 'verify_on_open', 'wal_max_size': parity_opts.pop(k, None)
+		with parity.DBParity(db_parity, db_path, log=log, **parity_opts) as db_check:
+			try:
+				fixed = db_check.verify(repair=not optz.dry_run)
+				fixed_parity = db_check.verify_parity(repair=not optz.dry_run)
+			except parity.DBCheckError as err:
+				log.error(str(err))
+				return 1
+		if not fixed and not fixed_parity: print('No errors found')
+		else:
+			print('{} corrupted db chunk(s), {} chunk group(s) with corrupted parity data{}'.format(
+				len(fixed), len(fixed_parity), ' (repaired)' if not optz.dry_run else '' ))
+			return 2 # same as with dry-run, so that repaired corruption doesn't go unnoticed
+		return
+	sla_report = dict() # set at the end of scrub run, as it needs a full pass over db
+	def metrics_collect():
+		if getattr(meta_db, 'generation', None) is None: return dict()
+		queue = meta_db.get_queue_stats()
+		gauges = dict( generation={(): meta_db.generation},
+			queue_files=dict(((('class', k),), v[0]) for k, v in queue.viewitems()),
+			queue_bytes=dict(((('class', k),), v[1]) for k, v in queue.viewitems()) )
+		for k in ['overdue_files', 'overdue_bytes', 'due_files', 'ok'] if sla_report else list():
+			gauges['sla_{}'.format(k)] = dict(
+				((('max_age_days', '{:g}'.format(max_age / 86400)),), int(stats[k]))
+				for max_age, stats in sla_report.viewitems() )
+		return gauges
+	metrics_cfg = cfg.operation.metrics
+	if metrics_cfg.format not in ['prometheus', 'json']:
+		parser.error('Unknown "operation.metrics.format" value: {!r}'.format(metrics_cfg.format))
+	scrub_metrics = metrics.Metrics( metrics_cfg.path, metrics_cfg.format,
+		interval=metrics_cfg.interval, collect=metrics_collect )
+
+	meta_db = None
 	with db.MetaDB( cfg.storage.metadata.db,
 			cfg.storage.metadata.db_parity, cfg.operation.checksum,
-			log_queries=cfg.logging.sql_queries,
-			use_fadvise=cfg.operation.use_fadvise,
-			commit_after=op.itemgetter('queries', 'seconds')\
-				(cfg.storage.metadata.db_commit_after) ) as meta_db:
+			parity_opts=parity_opts, metrics=scrub_metrics, lease=lease, **meta_db_kwz ) as meta_db:
 		if optz.call == 'scrub':
 			if optz.scan_only and optz.resume:
 				parser.error('Either --scan-only or --resume can be specified, not both.')
@@ -260,20 +1023,65 @@ def main(argv=None):
 			if not cfg.storage.path:
 				parser.error( 'At least one path to scrub must'
 					' be specified (via "storage.path" in config or on commandline).' )
-			scrub( cfg.storage.path, meta_db,
-				scan_only=optz.scan_only, resume=optz.resume,
-				xdev=cfg.storage.xdev, path_filter=cfg.storage.filter,
-				skip_for=skip_for, bs=cfg.operation.read_block,
-				rate_limits=cfg.operation.rate_limit )
+			budget = None
+			if not optz.scan_only:
+				time_limit = optz.time_budget or cfg.operation.budget.time
+				bytes_limit = optz.byte_budget or cfg.operation.budget.bytes
+				try:
+					time_limit = time_limit and parse_duration(time_limit)
+					bytes_limit = bytes_limit and bench.parse_size(bytes_limit)
+				except ValueError as err: parser.error(str(err))
+				if time_limit or bytes_limit or sla: budget = ScrubBudget(time_limit, bytes_limit)
+			try:
+				scrub( cfg.storage.path, meta_db, scan_only=optz.scan_only,
+					resume=optz.resume, budget=budget, **scrub_kwz )
+				if budget: sla_report.update(budget.report(meta_db))
+			finally: scrub_metrics.export(force=True)
+
+		elif optz.call == 'watch':
+			if optz.extra_paths: cfg.storage.path.extend(optz.extra_paths)
+			if not cfg.storage.path:
+				parser.error( 'At least one path to watch must'
+					' be specified (via "storage.path" in config or on commandline).' )
+			try:
+				watch( cfg.storage.path, meta_db,
+					backend=cfg.operation.watch.backend,
+					reconcile_interval=cfg.operation.watch.reconcile_interval,
+					reconcile=optz.reconcile, settle_delay=cfg.operation.watch.settle_delay,
+					**scrub_kwz )
+			finally: scrub_metrics.export(force=True)
+
+		elif optz.call == 'db-merge':
+			for path in optz.paths:
+				if not exists(path): parser.error('Metadata db file does not exist: {}'.format(path))
+				if realpath(path) == realpath(cfg.storage.metadata.db):
+					parser.error('Cannot merge metadata db into itself: {}'.format(path))
+			for path in optz.paths:
+				count = meta_db.merge(path)
+				log.info('Merged info on {} file(s) from: {}'.format(count, path))
 
 		elif optz.call == 'status':
-			first_row = True
-			for info in meta_db.list_paths():
-				if optz.dirty and not info['dirty']: continue
-				if optz.not_checked and info['clean']: continue
-				if optz.checked and not info['clean']: continue
+			if optz.checked and optz.not_checked:
+				parser.error('Only one of --checked or --not-checked can be specified.')
+			if optz.summary:
+				stats = meta_db.path_stats(prefix=optz.prefix)
+				if optz.json:
+					print(json.dumps(dict( (k, dict(files=files, bytes=size))
+						for k, (files, size) in stats.viewitems() ), sort_keys=True))
+				else:
+					for k in 'total', 'checked', 'not_checked', 'new', 'dirty', 'skipped':
+						files, size = stats[k]
+						print('{}: {} files, {:.1f} MiB'.format(k.replace('_', ' '), files, size / 2.0**20))
+				return
 
-				if not optz.verbose: print(info['path'])
+			first_row = True
+			for info in meta_db.list_paths(
+					dirty=optz.dirty or None, prefix=optz.prefix, limit=optz.limit,
+					clean=True if optz.checked else (False if optz.not_checked else None) ):
+				if optz.json:
+					info.update((k, v.isoformat()) for k, v in info.items() if isinstance(v, datetime))
+					print(json.dumps(dict(info, path=force_unicode(info['path'])), sort_keys=True))
+				elif not optz.verbose: print(info['path'])
 				else:
 					if not first_row: print()
 					else: first_row = False
@@ -2,23 +2,188 @@
 
 import itertools as it, operator as op, functools as ft
 from contextlib import contextmanager, closing
+from collections import deque
 from datetime import datetime
 from time import time
 from os.path import exists
-import os, sys, sqlite3, logging, hashlib
+import os, re, sys, io, errno, fcntl, mmap, socket, sqlite3, logging, hashlib, threading, Queue
 
 from fs_bitrot_scrubber.fadvise import fadvise
-from fs_bitrot_scrubber import force_unicode
+from fs_bitrot_scrubber.inotify import INotify
+from fs_bitrot_scrubber.parity import DBParity, DBCheckError, wal_chunks
+from fs_bitrot_scrubber.metrics import Metrics
+from fs_bitrot_scrubber.xattr import xattr_get, xattr_set, tag_pack, tag_unpack
+from fs_bitrot_scrubber import hashes, force_unicode
+
+
+# /usr/include/linux/fs.h, not in python2 os module
+SEEK_DATA, SEEK_HOLE = 3, 4
+
+
+class FileDigest(object):
+	'''Running checksum of file contents - either plain
+			hash of these or hash of concatenated per-block hashes.
+		holes - hash layout of holes in sparse files instead of zeroes in these, see hole().'''
+
+	def __init__(self, checksum, block_size=None, holes=False):
+		self.checksum, self.block_size, self.holes = checksum, block_size, holes
+		self.hash, self.blocks, self.block_pos = checksum(), list(), 0
+		self.pos, self.hole_list = 0, list()
+
+	def update(self, chunk):
+		if not self.block_size:
+			self.pos += len(chunk)
+			return self.hash.update(chunk)
+		while chunk:
+			n = self.block_size - self.block_pos
+			if len(chunk) > n: part, chunk = buffer(chunk, 0, n), buffer(chunk, n)
+			else: part, chunk = chunk, None
+			self.hash.update(part)
+			self.block_pos += len(part)
+			if self.block_pos == self.block_size: self._block_done()
+
+	def hole(self, length):
+		'''Add range of zeroes that is not allocated on disk (hole in a sparse file).
+			With "holes" enabled, (offset, length) of all holes in the file (or block)
+				are hashed after its data, instead of zeroes, so these don't have to be hashed.'''
+		if not self.holes:
+			zeroes = '\0' * min(length, 2**20)
+			while length > 0:
+				self.update(buffer(zeroes, 0, min(length, len(zeroes))))
+				length -= len(zeroes)
+			return
+		while length > 0:
+			if not self.block_size: n, offset = length, self.pos
+			else: n, offset = min(length, self.block_size - self.block_pos), self.block_pos
+			self.hole_list.append((offset, n))
+			length -= n
+			if not self.block_size: self.pos += n
+			else:
+				self.block_pos += n
+				if self.block_pos == self.block_size: self._block_done()
+
+	def _holes_done(self):
+		if not self.hole_list: return
+		self.hash.update('\0holes:' + ' '.join('{}:{}'.format(*hole) for hole in self.hole_list))
+		self.hole_list = list()
+
+	def _block_done(self):
+		self._holes_done()
+		self.blocks.append(self.hash.digest())
+		self.hash, self.block_pos = self.checksum(), 0
+
+	def digest(self):
+		if not self.block_size:
+			self._holes_done()
+			return self.hash.digest()
+		if self.block_pos: self._block_done()
+		return self.checksum(''.join(self.blocks)).digest()
+
+
+class ReadAhead(object):
+	'''Reads chunks of data in a separate thread, up to "depth" of these ahead of get() calls,
+			so that reading next chunk from disk and hashing the last one can happen at the same time.
+		read - function to read data with, either read(bs) -> str or,
+			if "buffers" pool (list) is passed, readinto-like read(buf) -> int.
+		eof_func - function to call from the thread when end of file is reached.'''
+
+	def __init__(self, read, bs, depth=2, buffers=None, eof_func=None):
+		self.read, self.bs, self.eof_func = read, bs, eof_func
+		self.chunks, self.free, self.done = Queue.Queue(), Queue.Queue(), False
+		self.buffers, self.buf_ring, self.buf_last = buffers, list(), list()
+		for n in xrange(max(2, depth)):
+			buf = None
+			if buffers is not None:
+				try: buf = buffers.pop()
+				except IndexError: pass
+				if buf is None or len(buf) != bs: buf = mmap.mmap(-1, bs)
+				self.buf_ring.append(buf)
+			self.free.put(buf)
+		self.thread = threading.Thread(target=self._run, name='ReadAhead')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _run(self):
+		try:
+			while True:
+				buf = self.free.get()
+				if self.done: break
+				chunk = self.read(self.bs) if buf is None else buffer(buf, 0, self.read(buf))
+				self.chunks.put((buf, chunk, None))
+				if not chunk:
+					if self.eof_func: self.eof_func()
+					break
+		except Exception as err: self.chunks.put((None, None, err))
+
+	def get(self):
+		'Returns next chunk, reusing buffer of the previously returned one.'
+		if self.buf_last: self.free.put(self.buf_last.pop())
+		buf, chunk, err = self.chunks.get()
+		if err: raise err
+		self.buf_last.append(buf)
+		return chunk
+
+	def close(self):
+		self.done = True
+		self.free.put(None) # in case thread waits for a free buffer
+		self.thread.join()
+		if self.buffers is not None: self.buffers.extend(self.buf_ring)
+		self.buf_ring = None
 
 
 class FileNode(object):
 
 	src_fadvise_count, src_fadvise_bs = 0, 60 * 2**20 # 60 MiB
 
-	def __init__(self, query_func, log, src, row, checksum, use_fadvise=True):
+	def __init__( self, query_func, log, src, row, checksum, algo=None,
+			use_fadvise=True, block_size=None, blocks=None, links=None, generation=None,
+			checksum_old=None, holes=False, holes_old=None,
+			read_buffers=None, pipeline=None, prefetch=None,
+			change_check=None, inotify=None, xattr=None, metrics=None ):
+		'''algo - name of the "checksum" hash, to store along with it.
+			checksum_old - hash that stored checksum was created with, if different.
+			holes/holes_old - whether hole layout of sparse files is hashed instead of zeroes
+				(see FileDigest.hole) for new/stored checksum, with holes skipped when reading file.
+			block_size - size of blocks to store checksums for (block map), if any.
+			blocks - stored block map rows for the path as (n, checksum, generation) tuples,
+				generation - current one, to resume from the blocks that were checked in it.
+			links - files table rows (with "path") for other hardlinks to the same inode,
+				which get the same check results, with bitrot reported for each one of these.
+			read_buffers - list to take reusable buffers from (and return these to)
+				to read data into, instead of allocating new string for each read() call.
+				"src" must be an unbuffered io.FileIO object in this case, possibly opened with O_DIRECT.
+			pipeline - number of chunks to read ahead in a separate thread while hashing, if any.
+			prefetch - function to call with number of bytes when file was read, to pre-read the next one.
+			change_check - (mode, value) tuple for how to detect file changes while reading it,
+				see "change_check" option in the config, where "inotify" mode requires INotify instance.
+			xattr - name of extended attribute to store checksum in, see MetaDB._metadata_new().
+			metrics - Metrics instance to count read/hash time and check results in.'''
 		self.q, self.log, self.meta, self.src = query_func, log, row, src
+		self.metrics = metrics or Metrics()
+		self.src_buffers, self.src_buf, self.src_skip = read_buffers, None, 0
+		self.src_pipe, self.src_pipe_depth, self.src_prefetch = None, pipeline, prefetch
+		self.src_check, self.src_check_n, self.src_check_ts = change_check or ('chunk', None), 0, time()
+		self.src_inotify, self.src_wd, self.src_read = inotify, None, 0
+		self.src_xattr = xattr
+		self.src_holes = holes or holes_old
+		self.src_pos, self.src_hole = 0, None # current offset and next hole offset with src_holes
+		self.src_direct = read_buffers is not None\
+			and bool(fcntl.fcntl(src.fileno(), fcntl.F_GETFL) & os.O_DIRECT)
 		self.log.debug(force_unicode('Checking file: {}'.format(row['path'])))
-		self.src_meta, self.src_checksum = self.stat(), checksum()
+		self.src_meta = self.stat()
+
+		# Stored checksum is verified using the same scheme it was created with,
+		#  and new one is calculated in parallel if that is different from configured one.
+		self.src_checksum, self.algo = FileDigest(checksum, block_size, holes), algo
+		self.src_checksum_old = None
+		if row['checksum'] is not None and (checksum_old or row['block_size'] != block_size):
+			self.src_checksum_old = FileDigest( checksum_old or checksum,
+				row['block_size'], holes if holes_old is None else holes_old )
+		self.blocks, self.blocks_bad, self.blocks_seen = dict(), list(), 0
+		self.generation, self.links = generation, links or list()
+		if block_size and row['block_size'] == block_size and not checksum_old:
+			self.blocks = dict((n, (digest, gen)) for n, digest, gen in (blocks or list()))
+			self.resume(generation)
 
 		self.src_fadvise = bool(use_fadvise)
 		if use_fadvise\
@@ -27,9 +192,28 @@ class FileNode(object):
 			self.src_fadvise_bs = use_fadvise
 		self.fadvise(seq=True)
 
+	def resume(self, generation):
+		'Skip blocks at the start of the file, if these were verified in current generation.'
+		if self.meta['dirty'] or self.meta['checksum'] is None\
+			or self.src_meta != tuple(self.meta[k] for k in ['size', 'ctime', 'mtime']): return
+		digests = self.src_checksum.blocks
+		while True:
+			digest, gen = self.blocks.get(len(digests), (None, None))
+			if gen != generation: break
+			digests.append(digest)
+		if not digests: return
+		self.blocks_seen = offset = len(digests)
+		offset *= self.src_checksum.block_size
+		self.src_pos = self.src_checksum.pos = offset
+		# O_DIRECT reads must be aligned, so some data before offset is read and skipped
+		if self.src_direct: self.src_skip = offset % mmap.PAGESIZE
+		self.src.seek(offset - self.src_skip)
+		self.log.debug(force_unicode( 'Resuming check from block'
+			' {} (offset: {}): {}'.format(len(digests), offset, self.meta['path']) ))
+
 	def fadvise(self, read_bytes=None, **fadvise_kwz):
 		'Advise kernel to avoid caching read data in RAM.'
-		if not self.src_fadvise: return
+		if not self.src_fadvise or self.src_direct: return
 		if read_bytes is None:
 			return fadvise(self.src, **fadvise_kwz)
 		assert not fadvise_kwz, fadvise_kwz
@@ -38,55 +222,273 @@ class FileNode(object):
 			fadvise(self.src, drop_cache=True)
 			self.src_fadvise_count = 0
 
+	def changed(self, chunk_len):
+		'''Check whether file has changed since it was opened, using configured strategy.
+			fstat() is always used at the end of the file (zero chunk_len).'''
+		mode, val = self.src_check
+		if chunk_len and mode != 'chunk':
+			if mode == 'eof': return False
+			elif mode == 'bytes':
+				self.src_check_n += chunk_len
+				if self.src_check_n < val: return False
+				self.src_check_n = 0
+			elif mode == 'seconds':
+				ts = time()
+				if ts - self.src_check_ts < val: return False
+				self.src_check_ts = ts
+			elif mode == 'inotify':
+				self.src_read += chunk_len
+				if self.src_wd is None:
+					if self.src_read >= self.src_meta[0]: return False # fstat() at the end follows
+					# Changes before watch was added will be detected by fstat() at the end
+					try: self.src_wd = self.src_inotify.add('/proc/self/fd/{}'.format(self.src.fileno()))
+					except OSError as err:
+						self.log.debug(force_unicode( 'Failed to add inotify watch ({}),'
+							' using fstat() after each read instead: {}'.format(err, self.meta['path']) ))
+						self.src_check = 'chunk', None
+				if self.src_wd is not None and not self.src_inotify.is_changed(self.src_wd): return False
+			else: raise ValueError(mode)
+		return self.stat() != self.src_meta
+
 	def stat(self):
 		# ctime change is also important here,
 		#  as it may indicate changes with reverted mtime,
 		#  which will produce false-positive otherwise
 		return op.attrgetter('st_size', 'st_ctime', 'st_mtime')(os.fstat(self.src.fileno()))
 
+	def blocks_check(self):
+		'Compare newly-hashed blocks with stored block map, storing checksums of matching/new ones.'
+		digests = self.src_checksum.blocks
+		for n in xrange(self.blocks_seen, len(digests)):
+			digest_old, gen = self.blocks.get(n, (None, None))
+			if digest_old is not None and digest_old != digests[n]:
+				self.blocks_bad.append(n) # updated only after file is processed
+				continue
+			self.q( 'INSERT OR REPLACE INTO blocks (file_id, n, checksum, generation)'
+				' VALUES (?, ?, ?, ?)', (self.meta['id'], n, digests[n], self.generation) )
+		self.blocks_seen = len(digests)
+
+	def blocks_update(self):
+		file_id, digests = self.meta['id'], self.src_checksum.blocks
+		for n in self.blocks_bad:
+			self.q( 'INSERT OR REPLACE INTO blocks (file_id, n, checksum, generation)'
+				' VALUES (?, ?, ?, ?)', (file_id, n, digests[n], self.generation) )
+		if self.meta['block_size']: # drop leftover blocks, if any
+			self.q('DELETE FROM blocks WHERE file_id = ? AND n >= ?', (file_id, len(digests)))
+
+	def blocks_bad_info(self):
+		if not self.blocks_bad: return ''
+		ranges, bs = list(), self.src_checksum.block_size
+		for n in self.blocks_bad:
+			if ranges and ranges[-1][1] == n * bs: ranges[-1][1] += bs
+			else: ranges.append([n * bs, (n + 1) * bs])
+		ranges[-1][1] = min(ranges[-1][1], self.src_meta[0])
+		return ' (changed byte ranges: {})'.format(
+			', '.join('{}-{}'.format(a, b) for a, b in ranges) )
+
+	def read_holes(self):
+		'''Skip hole in a sparse file at the current offset, if any, passing it to digests.
+			Returns offset of the next hole (or end of file), up to which data can be read.'''
+		fd, pos, size = self.src.fileno(), self.src_pos, self.src_meta[0]
+		try:
+			data = os.lseek(fd, pos, SEEK_DATA)
+			hole = os.lseek(fd, data, SEEK_HOLE)
+		except OSError as err:
+			if err.errno == errno.ENXIO: data = hole = size # hole until the end of file
+			elif err.errno == errno.EINVAL: data, hole = pos, size # not supported, read as usual
+			else: raise
+		data, hole = min(data, size), min(hole, size) # file changes are detected by fstat() later
+		if data > pos:
+			self.src_checksum.hole(data - pos)
+			if self.src_checksum_old: self.src_checksum_old.hole(data - pos)
+			self.metrics.add('bytes_sparse', data - pos)
+			self.src_pos, self.src_skip = data, 0
+		self.src.seek(data - self.src_skip) # lseek() changes fd offset, and python files need to know
+		return hole
+
+	def read_chunk(self, bs):
+		'Returns next chunk of file contents, either as a string or buffer object.'
+		extent = None # bytes left in current data extent, with src_holes
+		if self.src_holes and not self.src_pipe:
+			if self.src_hole is None or self.src_pos >= self.src_hole: self.src_hole = self.read_holes()
+			extent = self.src_hole - self.src_pos
+			if self.src_buffers is None: bs = min(bs, extent) # reused buffers are always filled
+		if self.src_direct: bs = -(-bs // mmap.PAGESIZE) * mmap.PAGESIZE
+		if self.src_pipe is None and self.src_pipe_depth and self.src_meta[0] > bs\
+				and (not self.src_holes or (extent and self.src_hole >= self.src_meta[0])): # no holes ahead
+			self.src_pipe = ReadAhead(
+				self.src.read if self.src_buffers is None else self.read_into,
+				bs, self.src_pipe_depth, self.src_buffers,
+				eof_func=self.src_prefetch and ft.partial(self.src_prefetch, bs * self.src_pipe_depth) )
+		if extent == 0: chunk = ''
+		elif self.src_pipe: chunk = self.src_pipe.get()
+		elif self.src_buffers is None:
+			block_size = self.src_checksum.block_size
+			if block_size: bs = min(bs, block_size - self.src_checksum.block_pos)
+			chunk = self.src.read(bs)
+		else:
+			if self.src_buf is None:
+				try: self.src_buf = self.src_buffers.pop()
+				except IndexError: pass
+				if self.src_buf is None or len(self.src_buf) != bs:
+					self.src_buf = mmap.mmap(-1, bs) # page-aligned, as required for O_DIRECT
+			chunk = buffer(self.src_buf, 0, self.read_into(self.src_buf))
+		if self.src_skip: chunk, self.src_skip = buffer(chunk, self.src_skip), 0
+		if extent is not None:
+			if len(chunk) > extent: chunk = buffer(chunk, 0, extent) # data read from the hole
+			self.src_pos += len(chunk)
+		if not chunk and not self.src_pipe and self.src_prefetch:
+			self.src_prefetch(bs * (self.src_pipe_depth or 1))
+		return chunk
+
+	def read_into(self, buf):
+		'Reads data into a buffer, returning number of bytes read.'
+		try: return self.src.readinto(buf)
+		except IOError as err:
+			if err.errno != errno.EINVAL or not self.src_direct: raise
+			# Some filesystems allow O_DIRECT open(), but not reads
+			self.log.debug(force_unicode( 'O_DIRECT read failed,'
+				' falling back to page cache: {}'.format(self.meta['path']) ))
+			fd = self.src.fileno()
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+			self.src_direct = False
+			self.fadvise(seq=True)
+			return self.src.readinto(buf)
+
 	def read(self, bs=2 * 2**20):
-		chunk = self.src.read(bs)
-		if self.stat() != self.src_meta:
+		# Explicit timestamps instead of metrics.timer() here to keep overhead low
+		ts = time()
+		chunk = self.read_chunk(bs)
+		self.metrics.add_time('read_io', time() - ts)
+		if self.changed(len(chunk)):
 			# Bail out if file changes while it's being hashed
-			self.q( 'UPDATE files SET dirty = 1,'
-				' last_skip = ? WHERE path = ?', (time(), self.meta['path']) )
+			self.q( 'UPDATE state SET dirty = 1, last_skip = ? WHERE file_id = ?',
+				list((time(), row['id']) for row in [self.meta] + self.links), many=True )
+			self.metrics.add('files_skipped')
 			return 0
+		ts = time()
 		if chunk:
 			self.src_checksum.update(chunk)
+			if self.src_checksum_old: self.src_checksum_old.update(chunk)
+			self.metrics.add_time('read_hash', time() - ts)
+			if self.src_checksum.block_size: self.blocks_check()
 			self.fadvise(len(chunk))
+			self.metrics.add('bytes_read', len(chunk))
 		else:
+			block_size = self.src_checksum.block_size
 			digest = self.src_checksum.digest()
-			size, ctime, mtime = self.src_meta
-			if self.meta['checksum'] != digest: # either new hash or changes
-				if self.meta['checksum'] is not None: # can still be intentional change w/ reverted mtime
-					if max(abs(self.meta['ctime'] - ctime), abs(self.meta['mtime'] - mtime)) >= 1:
-						self.log.info(force_unicode( 'Detected change in'
-							' file contents and ctime: {}'.format(self.meta['path']) ))
-					else: # bitrot!!!
-						self.log.error(force_unicode( 'Detected'
-							' unmarked changes: {}'.format(self.meta['path']) ))
+			digest_old = digest if not self.src_checksum_old else self.src_checksum_old.digest()
+			self.metrics.add_time('read_hash', time() - ts)
+			if block_size: self.blocks_check()
+			self.metrics.add('files_checked')
+			self.check_digest(self.meta, digest_old, self.blocks_bad_info())
+			self.blocks_update()
+			for row in self.links:
+				# Stored checksum of the link can only be compared if it was made with the same scheme
+				if (row['algo'], row['block_size']) == (self.algo, block_size): self.check_digest(row, digest)
+				elif (row['algo'], row['block_size']) == (self.meta['algo'], self.meta['block_size']):
+					self.check_digest(row, digest_old)
+				if row['block_size'] or block_size:
+					self.q('DELETE FROM blocks WHERE file_id = ?', (row['id'],))
+				if block_size:
+					self.q( 'INSERT INTO blocks (file_id, n, checksum, generation) SELECT ?, n, checksum,'
+						' generation FROM blocks WHERE file_id = ?', (row['id'], self.meta['id']) )
 			# Update with last-seen metadata,
 			#  regardless of what was set in metadata_check()
-			self.q( 'UPDATE files SET dirty = 0, clean = 1,'
-					' size = ?, mtime = ?, ctime = ?, checksum = ?, last_scrub = ?,'
-					' last_skip = NULL WHERE path = ?',
-				(size, mtime, ctime, digest, time(), self.meta['path']) )
+			size, ctime, mtime = self.src_meta
+			if self.src_xattr: ctime = self.xattr_update(digest, block_size) or ctime
+			file_ids = list((row['id'],) for row in [self.meta] + self.links)
+			self.q( 'UPDATE files SET size = ?, mtime = ?, ctime = ?,'
+					' checksum = ?, algo = ?, block_size = ? WHERE id = ?',
+				list((size, mtime, ctime, digest, self.algo, block_size) + k for k in file_ids), many=True )
+			self.q( 'UPDATE state SET dirty = 0, clean = 1, last_scrub = ?, last_skip = NULL,'
+				' moved = 0 WHERE file_id = ?', list((time(),) + k for k in file_ids), many=True )
+			if self.links: self.metrics.add('files_linked', len(self.links))
 		return len(chunk)
 
+	def read_failed(self, err):
+		'Mark file as skipped after read error (e.g. EIO from bad sector), to retry it later.'
+		self.log.error(force_unicode( 'Failed to read file,'
+			' skipping it ({}): {}'.format(err, self.meta['path']) ))
+		self.q( 'UPDATE state SET last_skip = ? WHERE file_id = ?',
+			list((time(), row['id']) for row in [self.meta] + self.links), many=True )
+		self.metrics.add('files_failed')
+
+	def check_digest(self, meta, digest, info=''):
+		'Compare calculated digest with one stored in files table row for the path, logging any changes.'
+		size, ctime, mtime = self.src_meta
+		if meta['checksum'] is None: self.metrics.add('files_new')
+		elif meta['checksum'] != digest: # can still be intentional change w/ reverted mtime
+			if max(abs(meta['ctime'] - ctime), abs(meta['mtime'] - mtime)) >= 1:
+				self.log.info(force_unicode( 'Detected change in'
+					' file contents and ctime: {}'.format(meta['path']) ))
+				self.metrics.add('files_changed')
+			elif meta['moved']: # matched by inode only, which could've been reused by other file
+				self.log.info(force_unicode( 'Detected change in file contents'
+					' after move (or new file on reused inode): {}'.format(meta['path']) ))
+				self.metrics.add('files_changed')
+			else: # bitrot!!!
+				self.log.error(force_unicode( 'Detected'
+					' unmarked changes: {}{}'.format(meta['path'], info) ))
+				self.metrics.add('files_bitrot')
+
+	def xattr_update(self, digest, block_size):
+		'''Store checksum in xattr tag on the file, unless it's already there.
+			Returns new ctime if tag was updated, as setting xattr changes it.'''
+		size, ctime, mtime = self.src_meta
+		tag, fd = tag_pack(digest, self.algo, block_size, size, mtime), self.src.fileno()
+		try:
+			if xattr_get(fd, self.src_xattr) == tag: return
+			xattr_set(fd, self.src_xattr, tag)
+		except OSError as err:
+			self.log.debug(force_unicode( 'Failed to update checksum'
+				' xattr tag ({}): {}'.format(err, self.meta['path']) ))
+			return
+		return self.stat()[1]
+
 	def close(self):
+		if self.src_pipe: self.src_pipe.close()
+		if self.src_wd is not None: self.src_inotify.remove(self.src_wd)
 		if self.src_fadvise: self.fadvise(drop_cache=True)
 		self.src.close()
-		self.src = self.src_meta = self.src_checksum = None
+		if self.src_buf is not None: self.src_buffers.append(self.src_buf)
+		self.src_buf = None
+		self.src = self.src_meta = self.src_checksum = self.src_checksum_old = self.src_pipe = None
+
+
+def algo_split(algo):
+	'Returns (hash_name, holes) for algo name stored with checksum, e.g. "sha256+holes".'
+	name, sep, opts = algo.partition('+')
+	return name, opts == 'holes'
+
+def path_split(path):
+	'Returns (dir, name) tuple for path, where dir has trailing slash, if any, and dir + name == path.'
+	path_dir, sep, name = path.rpartition('/')
+	return path_dir + sep, name
+
+def prefix_range(prefix):
+	'''Returns (start, end) range of strings that start with prefix, for indexed
+		"col >= start AND col < end" lookups instead of LIKE, end can be None (no upper bound).'''
+	end = prefix.rstrip('\xff')
+	return prefix, end and end[:-1] + chr(ord(end[-1]) + 1) or None
 
 
 class MetaDB(object):
 
+	_db_init = '''
+		CREATE TABLE IF NOT EXISTS meta (
+			var TEXT PRIMARY KEY ON CONFLICT REPLACE NOT NULL,
+			val TEXT NOT NULL
+		);
+	'''
+
+	# Initial schema, which is then updated by all _db_migrations
 	# clean - file was checked in this generation
 	# dirty - mtime/size was updated in this generation
 	# checksum - hash (binary)
 	# last_scrub - last time "clean" was set to true
 	# last_skip - last time failed to checksum due to rapid changes
-	_db_init = '''
+	_db_init_files = '''
 		CREATE TABLE IF NOT EXISTS files (
 			path BLOB PRIMARY KEY ON CONFLICT REPLACE NOT NULL,
 			generation INT NOT NULL,
@@ -99,168 +501,806 @@ class MetaDB(object):
 			last_scrub REAL NULL,
 			last_skip REAL NULL
 		);
-		CREATE INDEX IF NOT EXISTS files_checksum
-			ON files (generation, checksum, last_skip, last_scrub);
 		CREATE INDEX IF NOT EXISTS files_clean
 			ON files (generation, clean, last_skip, last_scrub);
-		CREATE INDEX IF NOT EXISTS files_dirty
-			ON files (generation, dirty, last_skip, last_scrub);
 		CREATE INDEX IF NOT EXISTS files_gen
 			ON files (generation);
+	'''
 
-		CREATE TABLE IF NOT EXISTS meta (
-			var TEXT PRIMARY KEY ON CONFLICT REPLACE NOT NULL,
-			val TEXT NOT NULL
-		);
+	# Priority class of the file in scrub queue - new (never checked), dirty or not-yet-checked
+	_db_queue_class = '(CASE WHEN last_scrub IS NULL THEN 0 WHEN dirty THEN 1 ELSE 2 END)'
+
+	# Each entry upgrades schema from the previous one, applied in order
+	_db_migrations = [
+		# dev - st_dev of the file, to group reads by device
+		'ALTER TABLE files ADD COLUMN dev INT NULL;',
+		# extent - physical offset of the first extent (FIEMAP), to order reads by
+		'ALTER TABLE files ADD COLUMN extent INT NULL;',
+		# Single index for get_file_to_scrub() query, replacing per-priority-class ones
+		'''DROP INDEX IF EXISTS files_checksum;
+			DROP INDEX IF EXISTS files_dirty;
+			CREATE INDEX IF NOT EXISTS files_queue ON files (generation, clean, last_skip IS NOT NULL,
+				(CASE WHEN checksum IS NULL THEN 0 WHEN dirty THEN 1 ELSE 2 END), last_scrub);''',
+		# block_size - size of blocks in block map, if checksum is a hash of their hashes
+		# blocks - block map, with generation when each block was last checked
+		'''ALTER TABLE files ADD COLUMN block_size INT NULL;
+			CREATE TABLE IF NOT EXISTS blocks (
+				path BLOB NOT NULL,
+				n INT NOT NULL,
+				checksum BLOB NOT NULL,
+				generation INT NOT NULL,
+				PRIMARY KEY (path, n)
+			) WITHOUT ROWID;''',
+		# algo - name of the hash that checksum (and block map) was created with
+		'ALTER TABLE files ADD COLUMN algo TEXT NULL;',
+		# Split into tables with integer keys:
+		#  dirs - interned directory paths (with trailing slash), as these repeat a lot
+		#  files - long-lived metadata and checksum for each (dir_id, name)
+		#  state - per-run (generation, clean, dirty) and scheduling info,
+		#   which is small and updated for all files on each scan
+		# Scrub queue index only has not-yet-checked files, and generation
+		#  is stored in meta table instead of separate index for it.
+		# Uses path_dir() and path_name() functions, registered in _init_db().
+		'''BEGIN;
+			CREATE TABLE dirs (
+				id INTEGER PRIMARY KEY NOT NULL,
+				path BLOB NOT NULL UNIQUE
+			);
+			INSERT INTO dirs (path) SELECT DISTINCT path_dir(path) FROM files;
+			CREATE TABLE files_v6 (
+				id INTEGER PRIMARY KEY NOT NULL,
+				dir_id INT NOT NULL,
+				name BLOB NOT NULL,
+				size INT NOT NULL,
+				mtime REAL NOT NULL,
+				ctime REAL NOT NULL,
+				checksum BLOB NULL,
+				algo TEXT NULL,
+				block_size INT NULL,
+				UNIQUE (dir_id, name)
+			);
+			INSERT INTO files_v6 (id, dir_id, name, size, mtime, ctime, checksum, algo, block_size)
+				SELECT f.rowid, d.id, path_name(f.path),
+					f.size, f.mtime, f.ctime, f.checksum, f.algo, f.block_size
+				FROM files f JOIN dirs d ON d.path = path_dir(f.path);
+			CREATE TABLE state (
+				file_id INTEGER PRIMARY KEY NOT NULL,
+				generation INT NOT NULL,
+				clean BOOLEAN NOT NULL,
+				dirty BOOLEAN NOT NULL,
+				dev INT NULL,
+				extent INT NULL,
+				last_scrub REAL NULL,
+				last_skip REAL NULL
+			);
+			INSERT INTO state (file_id, generation, clean, dirty, dev, extent, last_scrub, last_skip)
+				SELECT rowid, generation, clean, dirty, dev, extent, last_scrub, last_skip FROM files;
+			CREATE TABLE blocks_v6 (
+				file_id INT NOT NULL,
+				n INT NOT NULL,
+				checksum BLOB NOT NULL,
+				generation INT NOT NULL,
+				PRIMARY KEY (file_id, n)
+			) WITHOUT ROWID;
+			INSERT INTO blocks_v6 (file_id, n, checksum, generation)
+				SELECT f.rowid, b.n, b.checksum, b.generation FROM blocks b JOIN files f ON f.path = b.path;
+			DROP TABLE blocks;
+			ALTER TABLE blocks_v6 RENAME TO blocks;
+			DROP TABLE files;
+			ALTER TABLE files_v6 RENAME TO files;
+			CREATE INDEX state_queue ON state (generation, last_skip IS NOT NULL, {}, last_scrub)
+				WHERE clean = 0;
+			COMMIT;
+			VACUUM;'''.format(_db_queue_class),
+		# Partial index for list_paths(dirty=True), as only few files are usually dirty
+		'CREATE INDEX IF NOT EXISTS state_dirty ON state (file_id) WHERE dirty;',
+		# lease_owner/lease_until - files claimed from queue by one of the processes sharing db
+		'''ALTER TABLE state ADD COLUMN lease_owner TEXT NULL;
+			ALTER TABLE state ADD COLUMN lease_until REAL NULL;''',
+		# ino - st_ino for files with more than one hardlink, to only check each inode once
+		'''ALTER TABLE state ADD COLUMN ino INT NULL;
+			CREATE INDEX IF NOT EXISTS state_inode ON state (dev, ino) WHERE ino IS NOT NULL;''',
+		# nlink - st_nlink, as ino is stored for all files since, to match moved/renamed ones
+		'''ALTER TABLE state ADD COLUMN nlink INT NULL;
+			UPDATE state SET nlink = 2 WHERE ino IS NOT NULL;''',
+		# max_age - max seconds between checks from SLA class of the path, set on scan
+		# Queue is ordered by deadline (last_scrub + max_age) for files that have it
+		'''ALTER TABLE state ADD COLUMN max_age REAL NULL;
+			DROP INDEX IF EXISTS state_queue;
+			CREATE INDEX state_queue ON state (generation, last_skip IS NOT NULL, {},
+				max_age IS NULL, last_scrub + max_age, last_scrub) WHERE clean = 0;'''.format(_db_queue_class),
+		# moved - row was matched to a new path by inode only, which can be reused by a different file
+		'ALTER TABLE state ADD COLUMN moved BOOLEAN NOT NULL DEFAULT 0;' ]
+	# Checksums from before "algo" column are assumed to be created with configured hash
+	_db_migrations_algo = 5
+
+	# Same logic as in metadata_check(), but as upsert statements,
+	#  with rows that are already up-to-date for this generation not being rewritten.
+	# Files query is run first, as it checks "dirty" value from before the scan.
+	_db_scan_upsert_files = '''
+		INSERT INTO files (dir_id, name, size, mtime, ctime) VALUES (?, ?, ?, ?, ?)
+		ON CONFLICT (dir_id, name) DO UPDATE SET ctime = excluded.ctime
+		WHERE NOT (abs(mtime - excluded.mtime) <= 1 AND size = excluded.size)
+			AND NOT coalesce((SELECT dirty FROM state WHERE file_id = files.id), 0)
 	'''
+	_db_scan_upsert_state = '''
+		INSERT INTO state (file_id, generation, dev, ino, nlink, max_age, extent, clean, dirty)
+			SELECT id, ?, ?, ?, ?, ?, ?, 0, NOT (abs(mtime - ?) <= 1 AND size = ?)
+			FROM files WHERE dir_id = ? AND name = ?
+		ON CONFLICT (file_id) DO UPDATE SET
+			generation = excluded.generation, clean = 0, dev = excluded.dev, ino = excluded.ino,
+			nlink = excluded.nlink, max_age = excluded.max_age,
+			extent = excluded.extent, dirty = dirty OR excluded.dirty
+		WHERE generation != excluded.generation OR clean
+			OR dev IS NOT excluded.dev OR ino IS NOT excluded.ino OR nlink IS NOT excluded.nlink
+			OR max_age IS NOT excluded.max_age OR extent IS NOT excluded.extent
+			OR (excluded.dirty AND NOT dirty)
+	'''
+	_db_scan_upsert_min_version = 3, 24, 0
 
-	_db_migrations = []
+	# Pragmas that can be set via sqlite_opts, in order they're applied
+	# page_size has to be set before journal_mode, as it can't be changed in WAL mode
+	_sqlite_pragmas = 'page_size', 'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store'
 
 	_db = None
+	_scrub_queue_ttl = 600 # max seconds to keep queue batches, to pick up last_skip changes
 
 
 	def __init__( self, path, path_check=None, checksum=None,
-			use_fadvise=True, log=None, log_queries=False, commit_after=None ):
+			use_fadvise=True, log=None, log_queries=False,
+			commit_after=None, scan_batch=None, scrub_order='last_scrub', queue_batch=100,
+			block_map=None, read_engine='buffered', read_pipeline=None, change_check=None,
+			parity_opts=None, sqlite_opts=None, metrics=None, lease=None,
+			checksum_xattr=None, sparse_files=False, sla=None ):
 		self._log = logging.getLogger('bitrot_scrubber.MetaDB') if not log else log
+		self.metrics = metrics or Metrics()
 		self._log_sql = log_queries
-		self._checksum = hashlib.sha256 if not checksum else checksum
+		# checksum should be a name of the hash, see hashes module
+		self._checksum_name = checksum or 'sha256'
+		self._checksum = hashes.get(self._checksum_name)
+		# With sparse_files, holes are skipped and their layout is hashed instead (see FileDigest.hole),
+		#  which is stored as a different algo, so that checksums get converted as if hash was changed
+		self._sparse = bool(sparse_files)
+		self._algo = self._checksum_name + ('+holes' if self._sparse else '')
 		self._use_fadvise = use_fadvise
+		assert read_engine in ['buffered', 'readinto', 'direct'], read_engine
+		self._read_engine = read_engine
+		self._read_buffers = list() if read_engine != 'buffered' else None
+		self._read_pipeline = read_pipeline
+		# change_check should be a tuple of (mode, value), see FileNode.changed()
+		self._change_check, self._inotify = change_check, None
+		if change_check and change_check[0] == 'inotify':
+			try: self._inotify = INotify()
+			except (OSError, AttributeError) as err: # AttributeError - no such libc function
+				self._log.warning( 'Failed to initialize inotify'
+					' ({}), using fstat() after each read instead'.format(err) )
+				self._change_check = None
+		# block_map should be a tuple of (block_size, min_file_size)
+		self._block_size, self._block_min = block_map or (None, None)
+		self._xattr = checksum_xattr # name of xattr to store/find checksum tag in
+		# sla should be a list of (regexp, max_age) tuples, with first one matching path used,
+		#  and None instead of regexp matching any path, see also get_sla_stats()
+		self._sla = sla or list()
+		self._scrub_order, self._scrub_extent_pos = scrub_order, dict()
+		assert scrub_order in ['last_scrub', 'extent'], scrub_order
+		self._scrub_queue, self._scrub_queue_batch = dict(), max(1, queue_batch or 1)
 		self._db_path, self._db_parity = path, path_check
+		self._dirs = dict() # {path: id} cache for dirs table
+		# parity_opts - dict with DBParity keywords and "verify_on_open", "wal_max_size" values
+		parity_opts = dict(parity_opts or dict())
+		self._parity_sample = parity_opts.pop('verify_on_open', None)
+		self._parity_wal_max = parity_opts.pop('wal_max_size', None)
+		self._parity, self._parity_opts = None, parity_opts
+
+		# sqlite_opts - dict of {pragma: value}, see _sqlite_pragmas, None values are skipped
+		self._sqlite_opts = dict((k, v) for k, v in (sqlite_opts or dict()).viewitems() if v is not None)
+		for k, v in self._sqlite_opts.viewitems():
+			if k not in self._sqlite_pragmas or not re.search(r'^-?\w+$', bytes(v)):
+				raise ValueError('Invalid sqlite pragma or value: {!r} = {!r}'.format(k, v))
 
 		# commit_after should be a tuple of (queries, seconds)
-		seq, ts = (None, None) if commit_after else\
+		seq, ts = (None, None) if not commit_after else\
 			((v if v and v>=0 else None) for v in commit_after)
 		self._db_seq_limit, self._db_ts_limit = seq, ts
 		self._db_seq, self._db_ts = 0, time()
+		self.query_count = 0 # total number of queries, for stats
+
+		# lease should be a tuple of (seconds, owner), where owner is hostname:pid by default
+		# With it, files are claimed from queue before checking, so that
+		#  several processes can check files from same db without overlap.
+		self._lease, self._lease_owner, self._lease_ts = None, None, 0
+		if lease and lease[0]:
+			if path_check:
+				raise ValueError( 'Parity data for metadata db can'
+					' only be updated by one process, and should be disabled with leases' )
+			self._lease, self._lease_owner = float(lease[0]),\
+				lease[1] or '{}:{}'.format(socket.gethostname(), os.getpid())
+
+		if sqlite3.sqlite_version_info < self._db_scan_upsert_min_version: scan_batch = None
+		self._scan_batch, self._scan_buffer = scan_batch if scan_batch > 1 else None, list()
 
 		self._init_db()
 
 	@contextmanager
-	def _cursor(self, query, params=tuple(), **kwz):
+	def _cursor(self, query, params=tuple(), many=False, **kwz):
 		if self._log_sql:
 			self._log.debug(force_unicode('Query: {!r}, data: {!r}'.format(query, params)))
+		execute, ts0 = self._db.execute if not many else self._db.executemany, time()
 		try:
-			with closing(self._db.execute(query, params, **kwz)) as c: yield c
+			with closing(execute(query, params, **kwz)) as c: yield c
 		finally:
 			self._db_seq, ts = self._db_seq + 1, time()
+			self.query_count += 1
+			self.metrics.add_time('db_query', ts - ts0)
 			if (self._db_ts_limit and (ts - self._db_ts) >= self._db_ts_limit)\
-					or (self._db_seq_limit and self._db_seq >= self._db_seq_limit):
-				self._db.commit()
-				self._db_seq = 0
-			self._db_ts = ts
+				or (self._db_seq_limit and self._db_seq >= self._db_seq_limit): self._commit()
 
 	def _query(self, *query_argz, **query_kwz):
 		with self._cursor(*query_argz, **query_kwz): pass
 
+	def _commit(self):
+		with self.metrics.timer('db_commit'): self._db.commit()
+		self._db_seq, self._db_ts = 0, time()
+		if self._parity: self._parity_checkpoint()
+
 	def _parity_check(self):
-		# TODO: use zfec or something similar here
-		if not self._db_parity or not exists(self._db_parity): return
-		digest = hashlib.sha256()
-		with open(self._db_path) as db:
-			for chunk in iter(ft.partial(db.read, 2**20), ''): digest.update(chunk)
-		assert open(self._db_parity).read().strip() == digest.hexdigest(), 'DB check failed'
-
-	def _parity_write(self):
-		# TODO: use zfec or something similar here
 		if not self._db_parity: return
-		digest = hashlib.sha256()
-		with open(self._db_path) as db:
-			for chunk in iter(ft.partial(db.read, 2**20), ''): digest.update(chunk)
-		open(self._db_parity, 'w').write(digest.hexdigest())
+		if exists(self._db_parity) and not DBParity.is_parity_db(self._db_parity):
+			# Older versions stored sha256 hexdigest of the whole db there
+			digest = hashlib.sha256()
+			with open(self._db_path) as db:
+				for chunk in iter(ft.partial(db.read, 2**20), ''): digest.update(chunk)
+			if open(self._db_parity).read().strip() != digest.hexdigest():
+				raise DBCheckError('DB check failed')
+			os.unlink(self._db_parity)
+		self._parity = DBParity(self._db_parity, self._db_path, log=self._log, **self._parity_opts)
+		if exists(self._db_path):
+			with self.metrics.timer('parity'): self._parity.verify(sample=self._parity_sample)
+
+	def _parity_checkpoint(self, force=False):
+		'''Write changes from sqlite WAL into db file, updating parity data for all changed chunks.
+			Unless "force" is set, it's only done if WAL file is larger than wal_max_size.'''
+		wal_path = self._db_path + '-wal'
+		try: wal_size = os.stat(wal_path).st_size
+		except OSError: wal_size = 0
+		if not force and (not self._parity_wal_max or wal_size < self._parity_wal_max): return
+		with self.metrics.timer('parity'):
+			if wal_size:
+				self._parity.add_pending(wal_chunks(wal_path, self._parity.chunk_size))
+				with closing(self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')) as c:
+					busy, log, done = c.fetchone()
+				if busy or done != log:
+					# Chunks are left as pending, to be updated after next successful checkpoint
+					self._log.debug( 'Failed to checkpoint sqlite WAL'
+						' (busy: {}, pages: {}/{}), will retry later'.format(busy, done, log) )
+					return
+			if wal_size or self._parity.size is None or self._parity.get_pending():
+				self._parity.update(list())
 
 	def _init_db(self):
 		self._parity_check()
-		self._db = sqlite3.connect(self._db_path)
+		# Other processes can hold write lock for a while with leases, until their next commit
+		self._db = sqlite3.connect(self._db_path, timeout=5.0 if not self._lease else 120.0)
 		self._db.row_factory, self._db.text_factory = sqlite3.Row, str
+		pragmas = self._sqlite_opts.copy()
+		if self._parity:
+			# Other connections would checkpoint WAL into db file on close,
+			#  without updating parity data, so db is locked for this one only
+			self._db.execute('PRAGMA locking_mode = EXCLUSIVE').close()
+			# Pages changed in WAL are used to only update parity data for these,
+			#  so it's only checkpointed to db file from _parity_checkpoint()
+			if pragmas.get('journal_mode', 'wal').lower() != 'wal':
+				self._log.warning( 'Ignoring sqlite journal_mode={!r} option,'
+					' as WAL is required for db parity data'.format(pragmas['journal_mode']) )
+			pragmas['journal_mode'] = 'wal'
+		for k in self._sqlite_pragmas:
+			if k not in pragmas: continue
+			with self._cursor('PRAGMA {} = {}'.format(k, pragmas[k])) as c: row = c.fetchone()
+			if k == 'journal_mode' and row[0].lower() != pragmas[k].lower():
+				self._log.warning( 'Failed to set sqlite journal_mode'
+					' to {!r}, using {!r} instead'.format(pragmas[k], row[0]) )
+		if self._parity:
+			self._db.execute('PRAGMA wal_autocheckpoint = 0').close()
+			self._parity_checkpoint(force=True) # leftover changes from interrupted runs, if any
+		self._db.create_function('path_dir', 1, lambda path: path_split(path)[0])
+		self._db.create_function('path_name', 1, lambda path: path_split(path)[1])
 		with self._db as db: db.executescript(self._db_init)
-		with self._cursor("SELECT val FROM meta WHERE var = 'schema_version' LIMIT 1") as c:
+		# Note: "schema_version" value there was incremented on every
+		#  open by older versions, so separate counter is used for migrations
+		with self._cursor("SELECT val FROM meta WHERE var = 'schema_migrations' LIMIT 1") as c:
 			row = c.fetchone()
-			schema_ver = int(row['val']) if row else 1
+			schema_ver = schema_ver_old = int(row['val']) if row else 0
+		if not schema_ver:
+			with self._db as db: db.executescript(self._db_init_files)
 		for schema_ver, query in enumerate(
-			self._db_migrations[schema_ver-1:], schema_ver ): db.executescript(query)
-		self._query( 'INSERT INTO meta (var, val)'
-			" VALUES ('schema_version', '{}')".format(schema_ver + 1) )
+				self._db_migrations[schema_ver:], schema_ver + 1 ):
+			with self._db as db: db.executescript(query)
+			self._query( 'INSERT INTO meta (var, val)'
+				" VALUES ('schema_migrations', ?)", (str(schema_ver),) )
+		if schema_ver_old < self._db_migrations_algo <= schema_ver:
+			self._query( 'UPDATE files SET algo = ? WHERE'
+				' algo IS NULL AND checksum IS NOT NULL', (self._checksum_name,) )
 
 	def close(self):
+		if self._inotify:
+			self._inotify.close()
+			self._inotify = None
 		if self._db:
-			self._db.commit()
+			self.metadata_flush()
+			if self._lease: # files left in queue batches can be picked up by others
+				self._query( 'UPDATE state SET lease_owner = NULL,'
+					' lease_until = NULL WHERE lease_owner = ?', (self._lease_owner,) )
+			with self.metrics.timer('db_commit'): self._db.commit()
+			if self._parity: self._parity_checkpoint(force=True)
 			self._db.close()
 			self._db = None
-			if exists(self._db_path):
-				self._parity_write()
+		if self._parity:
+			self._parity.close()
+			self._parity = None
 
 	def __enter__(self): return self
 	def __exit__(self, *err): self.close()
 	def __del__(self): self.close()
 
 
-	def get_generation(self, new=True):
-		with self._cursor('SELECT generation'
-				' FROM files ORDER BY generation DESC LIMIT 1') as c:
+	def get_meta(self, var, default=None):
+		with self._cursor('SELECT val FROM meta WHERE var = ? LIMIT 1', (var,)) as c:
 			row = c.fetchone()
-		gen = row['generation'] if row else 0
+		return row['val'] if row else default
+
+	def set_meta(self, var, val):
+		self._query('INSERT INTO meta (var, val) VALUES (?, ?)', (var, bytes(val)))
+
+
+	def get_generation(self, new=True):
+		gen = self.get_meta('generation')
+		if gen is None: # db from older versions
+			with self._cursor('SELECT max(generation) AS gen FROM state') as c: gen = c.fetchone()['gen']
+		gen = int(gen or 0)
 		if new: gen += 1
 		return gen
 
 	def set_generation(self, new=True):
 		self.generation = self.get_generation(new=new)
+		if new: self.set_meta('generation', self.generation)
+
+
+	def _dir_id(self, path_dir):
+		dir_id = self._dirs.get(path_dir)
+		if dir_id is None:
+			self._query('INSERT OR IGNORE INTO dirs (path) VALUES (?)', (path_dir,))
+			with self._cursor('SELECT id FROM dirs WHERE path = ?', (path_dir,)) as c:
+				dir_id = self._dirs[path_dir] = c.fetchone()['id']
+		return dir_id
 
+	def _file_id(self, path):
+		path_dir, name = path_split(path)
+		with self._cursor( 'SELECT f.id FROM files f JOIN dirs d'
+				' ON d.id = f.dir_id WHERE d.path = ? AND f.name = ?', (path_dir, name) ) as c:
+			row = c.fetchone()
+		return row and row['id']
+
+
+	def _max_age(self, path):
+		for regexp, max_age in self._sla:
+			if not regexp or regexp.search(path): return max_age
 
-	def metadata_check(self, path, size, mtime, ctime):
-		with self._cursor('SELECT * FROM files WHERE path = ? LIMIT 1', (path,)) as c:
+	def metadata_check(self, path, size, mtime, ctime, dev=None, extent=None, ino=None, nlink=None):
+		'''Returns whether file was detected as new/dirty,
+			or None if that check is deferred until the next metadata_flush() call.
+			ino/nlink - st_ino/st_nlink, to detect moved files
+				and check each inode with multiple hardlinks only once.'''
+		max_age = self._max_age(path) if self._sla else None
+		if self._scan_batch:
+			self._scan_buffer.append(( path, self.generation,
+				size, mtime, ctime, dev, ino, nlink, max_age, extent ))
+			if len(self._scan_buffer) >= self._scan_batch: self.metadata_flush()
+			return
+		path_dir, name = path_split(path)
+		dir_id = self._dir_id(path_dir)
+		with self._cursor( 'SELECT f.id, f.size, f.mtime, f.ctime, s.dirty FROM files f'
+				' JOIN state s ON s.file_id = f.id WHERE f.dir_id = ? AND f.name = ?', (dir_id, name) ) as c:
 			row = c.fetchone()
 		if not row:
-			self._query( 'INSERT INTO files (path, generation,'
-					' size, mtime, ctime, clean, dirty) VALUES (?, ?, ?, ?, ?, 0, 0)',
-				(path, self.generation, size, mtime, ctime) )
+			with self._cursor( 'INSERT INTO files (dir_id, name, size, mtime, ctime)'
+				' VALUES (?, ?, ?, ?, ?)', (dir_id, name, size, mtime, ctime) ) as c: file_id = c.lastrowid
+			if self._metadata_new([(file_id, path, size, mtime, ctime, dev, ino)]):
+				return self.metadata_check(path, size, mtime, ctime, dev=dev, extent=extent, ino=ino, nlink=nlink)
+			self._query( 'INSERT INTO state (file_id, generation, dev, ino, nlink, max_age, extent, clean, dirty)'
+				' VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0)', (file_id, self.generation, dev, ino, nlink, max_age, extent) )
+			self._scrub_queue.clear()
 			return True
 		dirty = row['dirty']
-		if not dirty and not (abs(row['mtime'] - mtime) <= 1 and row['size'] == size): dirty = True
-		else: ctime = row['ctime'] # so it won't be set to a new value
-		self._query( 'UPDATE files SET generation = ?, ctime = ?,'
-			' clean = 0, dirty = ? WHERE path = ?', (self.generation, ctime, dirty, path) )
+		if not dirty and not (abs(row['mtime'] - mtime) <= 1 and row['size'] == size):
+			dirty = True
+			self._query('UPDATE files SET ctime = ? WHERE id = ?', (ctime, row['id']))
+		self._query( 'UPDATE state SET generation = ?, dev = ?, ino = ?, nlink = ?, max_age = ?,'
+				' extent = ?, clean = 0, dirty = ? WHERE file_id = ?',
+			(self.generation, dev, ino, nlink, max_age, extent, dirty, row['id']) )
+		if dirty: self._scrub_queue.clear()
 		return dirty
 
+	def metadata_flush(self):
+		'Write all metadata_check() results buffered for batch-update to db.'
+		if not self._scan_buffer: return
+		files, state, scanned = list(), list(), dict()
+		for path, gen, size, mtime, ctime, dev, ino, nlink, max_age, extent in self._scan_buffer:
+			path_dir, name = path_split(path)
+			dir_id = self._dir_id(path_dir)
+			files.append((dir_id, name, size, mtime, ctime))
+			state.append((gen, dev, ino, nlink, max_age, extent, mtime, size, dir_id, name))
+			scanned[dir_id, name] = path, size, mtime, ctime, dev, ino
+		# New rows get ids above the current max one, and are checked for moved files after upsert
+		with self._cursor('SELECT max(id) AS id FROM files') as c: file_id_max = c.fetchone()['id'] or 0
+		self._query(self._db_scan_upsert_files, files, many=True)
+		with self._cursor( 'SELECT id, dir_id, name FROM files'
+			' WHERE id > ?', (file_id_max,) ) as c: files = c.fetchall()
+		self._metadata_new(list((row['id'],) + scanned[row['dir_id'], row['name']] for row in files))
+		self._query(self._db_scan_upsert_state, state, many=True)
+		self._scan_buffer = list()
+		self._scrub_queue.clear()
+
+	def _metadata_new(self, files):
+		'''Checks whether just-added files rows (without state) are for files that were
+				moved/renamed from other paths in db, matched by (dev, ino, size, mtime),
+				where that inode no longer is, or have checksum in xattr tag, if these are enabled.
+			Row of the moved file replaces the new one, keeping its checksum, block map and
+				scrub history, so that it gets verified as usual, instead of hashed as a new file.
+			As inode numbers get reused, ctime must not be older than the stored one, and
+				checksum in xattr tag (if enabled) must be same as in db for such match.
+			Without xattr tags, such rows are flagged as "moved" in state table, and checksum
+				mismatch on the next check is reported as a change instead of bitrot.
+			"files" is a list of (file_id, path, size, mtime, ctime, dev, ino) tuples.
+			Returns set of file_id values for rows that were replaced in such way.'''
+		inodes, replaced, moved = dict(), set(), set()
+		for dev, dev_files in it.groupby(sorted(
+				(dev, ino) for file_id, path, size, mtime, ctime, dev, ino in files
+				if dev is not None and ino is not None ), key=op.itemgetter(0)):
+			dev_inodes = list(set(it.imap(op.itemgetter(1), dev_files)))
+			for n in xrange(0, len(dev_inodes), 500):
+				chunk = dev_inodes[n:n+500]
+				with self._cursor( 'SELECT f.id, s.dev, s.ino, f.size, f.mtime, f.ctime,'
+							' f.checksum, f.algo, f.block_size, d.path || f.name AS path'
+						' FROM state s JOIN files f ON f.id = s.file_id JOIN dirs d ON d.id = f.dir_id'
+						' WHERE s.dev = ? AND s.ino IN ({})'.format(', '.join(['?'] * len(chunk))),
+						[dev] + chunk ) as c:
+					for row in c: inodes.setdefault((row['dev'], row['ino']), list()).append(row)
+
+		for file_id, path, size, mtime, ctime, dev, ino in files:
+			tag = False # not fetched yet
+			for row in inodes.get((dev, ino), list()):
+				if row['id'] in moved or row['size'] != size or abs(row['mtime'] - mtime) > 1: continue
+				if ctime < row['ctime']: continue # renames only update ctime to a newer one
+				try: fstat = os.lstat(row['path'])
+				except OSError: fstat = None
+				if fstat and (fstat.st_dev, fstat.st_ino) == (dev, ino): continue # hardlink
+				if self._xattr and row['checksum'] is not None:
+					if tag is False: tag = self._xattr_tag(path)
+					if not tag or tag[:3] != (row['checksum'], row['algo'], row['block_size']): continue
+				self._log.debug(force_unicode('Detected moved file: {} -> {}'.format(row['path'], path)))
+				path_dir, name = path_split(path)
+				self._query('DELETE FROM files WHERE id = ?', (file_id,))
+				# ctime is updated on rename, and is used to tell bitrot from legitimate changes
+				self._query( 'UPDATE files SET dir_id = ?, name = ?, ctime = ?'
+					' WHERE id = ?', (self._dir_id(path_dir), name, ctime, row['id']) )
+				if not self._xattr and row['checksum'] is not None:
+					# Can be a new file on reused inode, with checksum mismatch not reported as bitrot
+					self._query('UPDATE state SET moved = 1 WHERE file_id = ?', (row['id'],))
+				self.metrics.add('files_moved')
+				replaced.add(file_id)
+				moved.add(row['id'])
+				break
+			if file_id in replaced or not self._xattr: continue
+			if tag is False: tag = self._xattr_tag(path)
+			if not tag or tag[3] != size or abs(tag[4] - mtime) > 1: continue
+			checksum, algo, block_size = tag[:3]
+			try: hashes.get(algo_split(algo)[0])
+			except LookupError: continue
+			self._log.debug(force_unicode('Using checksum from xattr tag: {}'.format(path)))
+			self._query( 'UPDATE files SET checksum = ?, algo = ?, block_size = ?'
+				' WHERE id = ?', (checksum, algo, block_size, file_id) )
+			self.metrics.add('files_moved')
+		return replaced
+
+	def _xattr_tag(self, path):
+		'Returns unpacked checksum xattr tag of the file, or None if it is missing or invalid.'
+		try: return tag_unpack(xattr_get(path, self._xattr))
+		except OSError as err:
+			self._log.debug(force_unicode( 'Failed to get checksum'
+				' xattr tag ({}): {}'.format(err, path) ))
+
 	def metadata_clean(self):
-		self._query('DELETE FROM files WHERE generation < ?', (self.generation,))
+		self.metadata_flush()
+		self._query( 'DELETE FROM blocks WHERE file_id IN'
+			' (SELECT file_id FROM state WHERE generation < ?)', (self.generation,) )
+		self._query( 'DELETE FROM files WHERE id IN'
+			' (SELECT file_id FROM state WHERE generation < ?)', (self.generation,) )
+		self._query('DELETE FROM state WHERE generation < ?', (self.generation,))
+		self._query('DELETE FROM dirs WHERE id NOT IN (SELECT dir_id FROM files)')
+		self._dirs.clear()
+		self._scrub_queue.clear()
+
+	def get_queue_stats(self):
+		'''Returns {class: (files, bytes)} for files left to check in this generation,
+			where class is one of "new", "dirty", "unchecked" or "skipped" (changed while being read).'''
+		stats = dict((k, (0, 0)) for k in ['new', 'dirty', 'unchecked', 'skipped'])
+		with self._cursor( 'SELECT {} AS class, last_skip IS NOT NULL AS skipped,'
+				' count(*) AS files, coalesce(sum(f.size), 0) AS bytes FROM state s'
+				' JOIN files f ON f.id = s.file_id WHERE generation = ? AND clean = 0'
+				' GROUP BY 1, 2'.format(self._db_queue_class), (self.generation,) ) as c:
+			for row in c:
+				k = 'skipped' if row['skipped'] else ['new', 'dirty', 'unchecked'][row['class']]
+				files, size = stats[k]
+				stats[k] = files + row['files'], size + row['bytes']
+		return stats
+
+	def get_sla_stats(self, ts=None, ts_next=None):
+		'''Returns {max_age: stats} for files in this generation that have SLA max age set,
+				where stats is a dict of files/bytes (total), overdue_files/overdue_bytes (ones not
+				checked within max_age by "ts" or never checked), due_files/due_bytes (same
+				by "ts_next", incl. overdue ones) and rate (bytes/s to check all of them in time).
+			Each inode with multiple hardlinks is only counted once, same as it is checked.'''
+		ts = ts or time()
+		ts_next = max(ts, ts_next or ts)
+		stats = dict()
+		with self._cursor( 'SELECT s.max_age AS max_age, count(*) AS files, coalesce(sum(f.size), 0) AS bytes,'
+					' coalesce(sum(f.size / s.max_age), 0) AS rate,'
+					' coalesce(sum(coalesce(s.last_scrub + s.max_age, 0) < ?), 0) AS overdue_files,'
+					' coalesce(sum(CASE WHEN coalesce(s.last_scrub + s.max_age, 0) < ? THEN f.size END), 0) AS overdue_bytes,'
+					' coalesce(sum(coalesce(s.last_scrub + s.max_age, 0) < ?), 0) AS due_files,'
+					' coalesce(sum(CASE WHEN coalesce(s.last_scrub + s.max_age, 0) < ? THEN f.size END), 0) AS due_bytes'
+				' FROM state s JOIN files f ON f.id = s.file_id WHERE s.generation = ? AND s.max_age IS NOT NULL'
+				' AND (coalesce(s.nlink, 1) < 2 OR s.file_id = (SELECT min(file_id) FROM state si'
+					' WHERE si.dev = s.dev AND si.ino = s.ino AND si.generation = s.generation))'
+				' GROUP BY s.max_age', (ts, ts, ts_next, ts_next, self.generation) ) as c:
+			for row in c: stats[row['max_age']] = dict((k, row[k]) for k in row.keys() if k != 'max_age')
+		return stats
+
+	def get_scrub_devs(self):
+		'Returns set of st_dev values for files left to check in this generation.'
+		with self._cursor( 'SELECT DISTINCT dev FROM state'
+				' WHERE generation = ? AND clean = 0', (self.generation,) ) as c:
+			return set(row['dev'] for row in c)
+
+	def _scrub_queue_fetch(self, skip_for, exclude, devs, limit):
+		'''Returns a list of rows for next files to check, in order of priority.
+			With leases, these rows are claimed first, skipping ones claimed by other processes.'''
+		where = 'generation = ? AND clean = 0 AND (last_skip IS NULL OR last_skip < ?)'
+		where_params = [self.generation, time() - skip_for]
+		# Only one path for each hardlinked inode is checked, with results copied to others
+		where += ' AND (coalesce(s.nlink, 1) < 2 OR s.file_id = (SELECT min(file_id) FROM state si'\
+			' WHERE si.dev = s.dev AND si.ino = s.ino AND si.generation = s.generation AND si.clean = 0))'
+		if devs is not None:
+			devs_known = list(dev for dev in devs if dev is not None)
+			query_dev = ['dev IN ({})'.format(', '.join(['?'] * len(devs_known)))]
+			if len(devs_known) != len(devs): query_dev.append('dev IS NULL')
+			where += ' AND ({})'.format(' OR '.join(query_dev))
+			where_params.extend(devs_known)
+		if exclude:
+			where += ' AND d.path || f.name NOT IN ({})'.format(', '.join(['?'] * len(exclude)))
+			where_params.extend(exclude)
+		# Files that weren't skipped due to changes come first, then -
+		#  not-yet-seen files, dirty (changed) ones and then just not-yet-checked ones
+		order, order_params = 'last_skip IS NOT NULL', list()
+		if self._sla:
+			# Files past their SLA deadline go before all others, most overdue ones first
+			order += ', CASE WHEN last_scrub + max_age < ? THEN last_scrub + max_age ELSE ? END'
+			order_params.extend([time()] * 2)
+		order += ', {}'.format(self._db_queue_class)
+		if self._scrub_order == 'extent':
+			# Elevator-style sweep in order of physical offsets, starting from the last one,
+			#  with files that have no such offset (e.g. fs without FIEMAP) picked last
+			order += ', extent IS NULL, extent < ?, extent'
+			order_params.append(self._scrub_extent_pos.get(devs and tuple(devs), 0))
+		# Files with SLA deadline first, in order of these, see "state_queue" index
+		order += ', max_age IS NULL, last_scrub + max_age, last_scrub'
+		query = 'SELECT d.path || f.name AS path, f.*, s.* FROM state s'\
+			' JOIN files f ON f.id = s.file_id JOIN dirs d ON d.id = f.dir_id'\
+			' WHERE {} ORDER BY {}'
+		if not self._lease:
+			with self._cursor( query.format(where, order) + ' LIMIT ?',
+				where_params + order_params + [limit] ) as c: return c.fetchall()
 
-	def get_file_to_scrub(self, skip_for=3 * 3600, skip_until=0):
+		# Single UPDATE statement takes write lock, so files can't be claimed by two processes
+		ts = time()
+		lease = [self._lease_owner, ts + self._lease]
+		self._query( 'UPDATE state SET lease_owner = ?, lease_until = ? WHERE file_id IN'
+				' (SELECT s.file_id FROM state s JOIN files f ON f.id = s.file_id JOIN dirs d ON d.id = f.dir_id'
+				' WHERE {} AND (lease_until IS NULL OR lease_until < ? OR lease_owner = ?)'
+				' ORDER BY {} LIMIT ?)'.format(where, order),
+			lease + where_params + [ts, self._lease_owner] + order_params + [limit] )
+		self._commit() # make claim visible to other processes
+		self._lease_ts = ts
+		with self._cursor( query.format( 'generation = ? AND clean = 0'
+				' AND lease_owner = ? AND lease_until = ?', order ),
+			[self.generation] + lease + order_params ) as c: return c.fetchall()
+
+	def lease_renew(self):
+		'Extend leases on files claimed by this process, when half of the lease time has passed.'
+		if not self._lease: return
+		ts = time()
+		if ts - self._lease_ts < self._lease / 2: return
+		self._query( 'UPDATE state SET lease_until = ? WHERE generation = ? AND clean = 0'
+			' AND lease_owner = ?', (ts + self._lease, self.generation, self._lease_owner) )
+		self._commit()
+		self._lease_ts = ts
+
+	def get_file_to_scrub(self, skip_for=3 * 3600, exclude=None, devs=None):
+		'''Returns FileNode for next path to check, except for ones in "exclude" set.
+			"devs" can be a list of st_dev values (incl. None for unknown) to pick files from.
+			Rows are fetched in batches, which are dropped on any metadata updates from scan.'''
+		ts = time()
+		try: return self._get_file_to_scrub(skip_for, exclude, devs)
+		finally: self.metrics.add_time('queue', time() - ts)
+
+	def _get_file_to_scrub(self, skip_for, exclude, devs):
+		queue_key = devs and tuple(devs)
+		self.lease_renew()
 		while True:
-			query_base = 'SELECT * FROM files WHERE generation = ?'\
-				' AND (last_skip IS NULL OR last_skip < ?) {} ORDER BY last_scrub LIMIT 1'
-			query_params = [self.generation, skip_until]
-			# First try to hash not-yet-seen files
-			with self._cursor(query_base.format('AND checksum IS NULL'), query_params) as c:
-				row = c.fetchone()
-			if not row:
-				# Then dirty (changed) files
-				with self._cursor(query_base.format('AND dirty = 1'), query_params) as c:
-					row = c.fetchone()
-			if not row:
-				# Then just not-yet-checked for this generation
-				with self._cursor(query_base.format('AND clean = 0'), query_params) as c:
-					row = c.fetchone()
-			if not row and skip_until == 0:
-				# Then try to find a path that was skipped a while ("skip_for") ago
-				skip_until = time() - skip_for
-				if skip_until != 0: return self.get_file_to_scrub(skip_until=skip_until)
-			if not row: return # nothing more/yet to check
-			try: src = open(row['path'])
+			ts, queue = self._scrub_queue.get(queue_key, (0, None))
+			if not queue or time() - ts > self._scrub_queue_ttl:
+				queue = deque(self._scrub_queue_fetch(
+					skip_for, exclude, devs, limit=self._scrub_queue_batch ))
+				self._scrub_queue[queue_key] = time(), queue
+				if not queue: return # nothing more/yet to check
+			row = queue.popleft()
+			if exclude and row['path'] in exclude: continue
+			if row['extent'] is not None: self._scrub_extent_pos[queue_key] = row['extent']
+			algo_old, checksum_old, holes_old = row['algo'] or self._checksum_name, None, self._sparse
+			if row['checksum'] is not None and algo_old != self._algo:
+				algo_old, holes_old = algo_split(algo_old)
+				try: checksum_old = hashes.get(algo_old)
+				except LookupError:
+					self._log.error(force_unicode( 'Hash that stored checksum was created'
+						' with is not available ({}), skipping file: {}'.format(algo_old, row['path']) ))
+					self._query('UPDATE state SET last_skip = ? WHERE file_id = ?', (time(), row['id']))
+					continue
+			try: src = self._open(row['path'])
 			except (IOError, OSError):
 				self._log.debug(force_unicode( 'Failed to open'
 					' scanned path, skipping it: {}'.format(row['path']) ))
 				self.drop_file(row['path'])
 				continue
+			block_size = self._block_size\
+				if self._block_size and row['size'] >= self._block_min else None
+			blocks = links = None
+			if block_size and row['block_size'] == block_size and not checksum_old:
+				with self._cursor( 'SELECT n, checksum, generation'
+						' FROM blocks WHERE file_id = ?', (row['id'],) ) as c: blocks = c.fetchall()
+			if (row['nlink'] or 0) > 1:
+				with self._cursor( 'SELECT d.path || f.name AS path, f.*, s.moved FROM state s'
+						' JOIN files f ON f.id = s.file_id JOIN dirs d ON d.id = f.dir_id'
+						' WHERE s.dev = ? AND s.ino = ? AND s.generation = ? AND s.file_id != ?',
+						(row['dev'], row['ino'], self.generation, row['id']) ) as c: links = c.fetchall()
 			return FileNode( self._query, self._log, src, row,
-				checksum=self._checksum, use_fadvise=self._use_fadvise )
+				checksum=self._checksum, algo=self._algo, holes=self._sparse, holes_old=holes_old,
+				use_fadvise=self._use_fadvise, block_size=block_size,
+				blocks=blocks, links=links, generation=self.generation, checksum_old=checksum_old,
+				read_buffers=self._read_buffers, pipeline=self._read_pipeline,
+				change_check=self._change_check, inotify=self._inotify,
+				xattr=self._xattr, metrics=self.metrics,
+				prefetch=queue and self._read_pipeline and self._read_engine != 'direct'
+					and ft.partial(self._prefetch, queue[0]['path']) or None )
+
+	def _prefetch(self, path, size):
+		'Hint kernel to start reading the start of the file into page cache.'
+		try: fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+		except OSError: return
+		try: fadvise(fd, willneed=size)
+		finally: os.close(fd)
+
+	def _open(self, path):
+		if self._read_engine == 'buffered': return open(path)
+		if self._read_engine == 'direct':
+			try: return io.open(os.open(path, os.O_RDONLY | os.O_DIRECT), 'rb', buffering=0)
+			except OSError as err: # e.g. tmpfs, fall back to page cache
+				if err.errno != errno.EINVAL: raise
+		return io.open(os.open(path, os.O_RDONLY), 'rb', buffering=0)
 
 	def drop_file(self, path):
-		self._query('DELETE FROM files WHERE generation = ? AND path = ?', (self.generation, path))
+		file_id = self._file_id(path)
+		if file_id is None: return
+		self._query('DELETE FROM blocks WHERE file_id = ?', (file_id,))
+		with self._cursor( 'DELETE FROM state WHERE generation = ?'
+			' AND file_id = ?', (self.generation, file_id) ) as c: dropped = c.rowcount
+		if dropped: self._query('DELETE FROM files WHERE id = ?', (file_id,))
+
+	def _paths_filter(self, dirty=None, clean=None, prefix=None):
+		'Returns (where, params) for list_paths() and path_stats() queries.'
+		where, params = list(), list()
+		if dirty is not None: where.append('s.dirty' if dirty else 'NOT s.dirty')
+		if clean is not None: where.append('s.clean = {:d}'.format(bool(clean)))
+		if prefix:
+			def prefix_cond(col, val):
+				start, end = prefix_range(val)
+				if end is None: return '{} >= ?'.format(col), [start]
+				return '{0} >= ? AND {0} < ?'.format(col), [start, end]
+			# Either dirs that start with prefix or files with prefix-matching names in its dir
+			cond, cond_params = prefix_cond('d.path', prefix)
+			path_dir, name = path_split(prefix)
+			if name:
+				cond_name, cond_name_params = prefix_cond('f.name', name)
+				cond = '({}) OR (d.path = ? AND {})'.format(cond, cond_name)
+				cond_params += [path_dir] + cond_name_params
+			where.append('({})'.format(cond))
+			params.extend(cond_params)
+		return ' AND '.join(where) or '1', params
 
-	def list_paths(self):
-		with self._cursor('SELECT * FROM files') as c:
+	def merge(self, path):
+		'''Merge info on files from another metadata db (e.g. one used to check different shard
+				of files on another host) into this one, returning number of added/updated files.
+			Files that are in both dbs are only updated if these were checked more recently in the other one.
+			Merged files are assigned current generation, and their st_dev values are dropped.'''
+		# Opening other db with MetaDB first upgrades its schema, if necessary
+		MetaDB(path, checksum=self._checksum_name, log=self._log).close()
+		self.metadata_flush()
+		self._commit() # ATTACH can't be done within transaction
+		self._query('ATTACH DATABASE ? AS src', (path,))
+		try:
+			gen = self.get_generation(new=False)
+			self._query('INSERT OR IGNORE INTO dirs (path) SELECT path FROM src.dirs')
+			self._query('DROP TABLE IF EXISTS temp.merge_files')
+			self._query( 'CREATE TEMP TABLE merge_files AS'
+				' SELECT sf.id AS src_id, d.id AS dir_id, sf.name AS name, f.id AS file_id'
+				' FROM src.files sf JOIN src.dirs sd ON sd.id = sf.dir_id'
+				' JOIN src.state ss ON ss.file_id = sf.id JOIN dirs d ON d.path = sd.path'
+				' LEFT JOIN files f ON f.dir_id = d.id AND f.name = sf.name'
+				' LEFT JOIN state s ON s.file_id = f.id'
+				' WHERE f.id IS NULL OR coalesce(ss.last_scrub, 0) > coalesce(s.last_scrub, 0)' )
+			for table, col in [('blocks', 'file_id'), ('state', 'file_id'), ('files', 'id')]:
+				self._query( 'DELETE FROM {} WHERE {} IN (SELECT file_id'
+					' FROM temp.merge_files WHERE file_id IS NOT NULL)'.format(table, col) )
+			self._query( 'INSERT INTO files (dir_id, name, size, mtime, ctime, checksum, algo, block_size)'
+				' SELECT m.dir_id, m.name, sf.size, sf.mtime, sf.ctime, sf.checksum, sf.algo, sf.block_size'
+				' FROM temp.merge_files m JOIN src.files sf ON sf.id = m.src_id' )
+			self._query( 'UPDATE temp.merge_files SET file_id = (SELECT id FROM files f'
+				' WHERE f.dir_id = merge_files.dir_id AND f.name = merge_files.name)' )
+			self._query( 'INSERT INTO state (file_id, generation, clean, dirty, extent, last_scrub, last_skip)'
+				' SELECT m.file_id, ?, ss.clean, ss.dirty, ss.extent, ss.last_scrub, ss.last_skip'
+				' FROM temp.merge_files m JOIN src.state ss ON ss.file_id = m.src_id', (gen,) )
+			# Block map is used for checking, but not as verified in any generation of this db
+			self._query( 'INSERT INTO blocks (file_id, n, checksum, generation)'
+				' SELECT m.file_id, b.n, b.checksum, 0 FROM temp.merge_files m'
+				' JOIN src.blocks b ON b.file_id = m.src_id' )
+			with self._cursor('SELECT count(*) FROM temp.merge_files') as c: count = c.fetchone()[0]
+			self._query('DROP TABLE temp.merge_files')
+			self._commit()
+		finally:
+			self._db.rollback()
+			self._query('DETACH DATABASE src')
+		self._dirs.clear()
+		self._scrub_queue.clear()
+		return count
+
+	def list_paths(self, dirty=None, clean=None, prefix=None, limit=None):
+		'''Yields info dicts for files in db, optionally filtered by dirty/clean flags
+			and path prefix (string, not necessarily a directory), up to "limit" of these.
+			Rows are not sorted, so that these can be streamed without reading all of them first.'''
+		where, params = self._paths_filter(dirty, clean, prefix)
+		query = 'SELECT d.path || f.name AS path, f.size, s.* FROM dirs d'\
+			' JOIN files f ON f.dir_id = d.id JOIN state s ON s.file_id = f.id'\
+			' WHERE {}'.format(where)
+		if limit:
+			query += ' LIMIT ?'
+			params.append(limit)
+		with self._cursor(query, params) as c:
 			for row in c:
 				yield dict(
-					path=row['path'], clean=bool(row['clean']), dirty=bool(row['dirty']),
+					path=row['path'], size=row['size'], clean=bool(row['clean']), dirty=bool(row['dirty']),
 					last_scrub=datetime.fromtimestamp(row['last_scrub']) if row['last_scrub'] else None,
 					last_skip=datetime.fromtimestamp(row['last_skip']) if row['last_skip'] else None )
+
+	def path_stats(self, prefix=None):
+		'''Returns {state: (files, bytes)} dict for all files in db (or ones matching prefix),
+			where state is one of total, checked (on the last run), not_checked, new (never checked),
+			dirty (known to be modified since last checksum update) or skipped (changed while being read).'''
+		where, params = self._paths_filter(prefix=prefix)
+		states = [ ('total', '1'), ('checked', 's.clean'), ('not_checked', 'NOT s.clean'),
+			('new', 's.last_scrub IS NULL'), ('dirty', 's.dirty'), ('skipped', 's.last_skip IS NOT NULL') ]
+		query = ', '.join(
+			'coalesce(sum({0}), 0), coalesce(sum(CASE WHEN {0} THEN f.size END), 0)'.format(cond)
+			for k, cond in states )
+		with self._cursor( 'SELECT {} FROM dirs d JOIN files f ON f.dir_id = d.id'
+				' JOIN state s ON s.file_id = f.id WHERE {}'.format(query, where), params ) as c:
+			row = c.fetchone()
+		return dict((k, (row[n*2], row[n*2 + 1])) for n, (k, cond) in enumerate(states))
@@ -2,19 +2,23 @@
 
 # /usr/include/linux/fadvise.h
 POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
 POSIX_FADV_DONTNEED = 4
 
-libc = offset = length = None
+libc = offset = length = c_uint64 = None
 
-def fadvise(fd, seq=False, drop_cache=False):
-	'Avoid filling disk cache with discardable data.'
-	global libc, offset, length
+def fadvise(fd, seq=False, drop_cache=False, willneed=None):
+	'''Avoid filling disk cache with discardable data.
+		willneed - number of bytes from the start of the file to pre-read into cache.'''
+	global libc, offset, length, c_uint64
 	if not libc: # only import and initialize ctypes if used
 		import ctypes, ctypes.util
 		libc = ctypes.CDLL(ctypes.util.find_library('c'))
 		offset = length = ctypes.c_uint64(0)
+		c_uint64 = ctypes.c_uint64
 	if not isinstance(fd, (int, long)): fd = fd.fileno()
 
 	# These don't work (EINVAL) when or'ed
 	if seq: libc.posix_fadvise(fd, offset, length, POSIX_FADV_SEQUENTIAL)
 	if drop_cache: libc.posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+	if willneed: libc.posix_fadvise(fd, offset, c_uint64(willneed), POSIX_FADV_WILLNEED)
@@ -0,0 +1,42 @@
+#-*- coding: utf-8 -*-
+
+import os, errno, struct, array, logging
+
+from fs_bitrot_scrubber import force_unicode
+
+# /usr/include/linux/fiemap.h
+FS_IOC_FIEMAP = 0xc020660b - 2**32 # as signed int, which python2 fcntl.ioctl expects
+FIEMAP_MAX_OFFSET = 2**64 - 1
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_DATA_INLINE = 0x200
+
+fiemap_struct = struct.Struct('=QQLLLL') # start, length, flags, mapped_extents, extent_count, reserved
+fiemap_extent_struct = struct.Struct('=QQQ2QL3L') # logical, physical, length, reserved64, flags, reserved
+
+fcntl = None
+
+def first_extent(path_or_fd):
+	'''Returns physical offset (in bytes) of the first extent of the file,
+		or None if it's empty, inline, if filesystem does not support FIEMAP ioctl or it fails.'''
+	global fcntl
+	if not fcntl: import fcntl
+	if isinstance(path_or_fd, (int, long)): fd = path_or_fd
+	else:
+		try: fd = os.open(path_or_fd, os.O_RDONLY | os.O_NONBLOCK) # in case of fifo
+		except OSError: return
+
+	buff = array.array('B', fiemap_struct.pack(
+		0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0 ) + '\0' * fiemap_extent_struct.size)
+	try: fcntl.ioctl(fd, FS_IOC_FIEMAP, buff, True)
+	except (IOError, OSError) as err:
+		# File is just ordered without extent on any errors (e.g. EIO), same as on unsupported fs
+		if err.errno not in [errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EBADR]:
+			logging.getLogger('bitrot_scrubber.fiemap').debug(force_unicode(
+				'Failed to get file extents ({}): {}'.format(err, path_or_fd) ))
+		return
+	finally:
+		if fd != path_or_fd: os.close(fd)
+	if not fiemap_struct.unpack_from(buff)[3]: return # no extents mapped
+	extent = fiemap_extent_struct.unpack_from(buff, fiemap_struct.size)
+	if extent[-4] & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DATA_INLINE): return
+	return extent[1]
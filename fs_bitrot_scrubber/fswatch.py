@@ -0,0 +1,232 @@
+#-*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from os.path import join, realpath
+from time import time
+import os, errno, stat, struct, select, threading, logging
+
+from fs_bitrot_scrubber import inotify, force_unicode, scandir
+from fs_bitrot_scrubber.inotify import (
+	IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+	IN_CREATE, IN_DELETE, IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR,
+	IN_DONT_FOLLOW, IN_EXCL_UNLINK, IN_ISDIR, IN_CLOEXEC )
+
+
+# /usr/include/linux/fanotify.h
+FAN_MODIFY = 0x00000002
+FAN_CLOSE_WRITE = 0x00000008
+FAN_Q_OVERFLOW = 0x00004000
+FAN_CLOEXEC = 0x00000001
+FAN_CLASS_NOTIF = 0x00000000
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_FILESYSTEM = 0x00000100
+AT_FDCWD = -100
+
+
+class FSWatch(object):
+	'''Base class for filesystem event watchers, which collect paths of
+			changed (incl. new or possibly removed) files from a background thread.
+		"roots" is a dict of {path: st_dev} for realpaths to watch,
+			check_filters - function to check whether directory path (with trailing slash) should be watched.
+		Subclasses define _init() to return fd to read events from, and _process(buff) for these.'''
+
+	_read_bs = 64 * 2**10
+
+	def __init__(self, roots, xdev=True, check_filters=None):
+		self.log = logging.getLogger('bitrot_scrubber.watch')
+		self.roots, self.xdev = roots, xdev
+		self.check_filters = check_filters or (lambda path: True)
+		self.pending, self.overflow, self.lock = dict(), False, threading.Lock()
+		self.fd = self._init()
+		self.ctl_r, self.ctl_w = os.pipe()
+		self.thread = threading.Thread(target=self._run, name=type(self).__name__)
+		self.thread.daemon = True
+		self.thread.start()
+		try: self._setup()
+		except:
+			self.close()
+			raise
+
+	def _setup(self): pass
+
+	def root(self, path):
+		'Returns closest root for path, or None if its not under any of these.'
+		for p in sorted(self.roots, key=len, reverse=True):
+			if path == p or path.startswith(p.rstrip('/') + '/'): return p
+
+	def changed(self, path):
+		with self.lock: self.pending[path] = time()
+
+	def get_changes(self, settle_delay=0):
+		'''Returns list of paths that had no new events for at least
+			settle_delay seconds and whether any events were lost since the last call.'''
+		ts, paths = time() - settle_delay, list()
+		with self.lock:
+			for path, ts_ev in self.pending.items():
+				if ts_ev > ts: continue
+				paths.append(path)
+				del self.pending[path]
+			overflow, self.overflow = self.overflow, False
+		return paths, overflow
+
+	def _run(self):
+		while True:
+			try: rlist, wlist, xlist = select.select([self.fd, self.ctl_r], [], [])
+			except select.error as err:
+				if err.args[0] == errno.EINTR: continue
+				raise
+			if self.ctl_r in rlist: break
+			try: buff = os.read(self.fd, self._read_bs)
+			except OSError as err:
+				if err.errno in [errno.EINTR, errno.EAGAIN]: continue
+				raise
+			try: self._process(buff)
+			except Exception:
+				self.log.exception('Failed to process fs events')
+				self.overflow = True # to pick up missed changes
+
+	def close(self):
+		if self.fd is None: return
+		os.write(self.ctl_w, '\0')
+		self.thread.join()
+		for fd in self.fd, self.ctl_r, self.ctl_w: os.close(fd)
+		self.fd = None
+
+
+class INotifyTreeWatch(FSWatch):
+	'''Recursive inotify watches on all directories under root paths.
+		Number of these is limited by fs.inotify.max_user_watches sysctl,
+			and directories that can't be watched are only checked on full scans.'''
+
+	_ev = struct.Struct('=iIII') # struct inotify_event, followed by name
+	_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE\
+		| IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+	def _init(self):
+		self.wds, self.wds_failed = dict(), False # {wd: (path, dev)}
+		return inotify.check(inotify.libc_init().inotify_init1(IN_CLOEXEC))
+
+	def _setup(self):
+		for path, dev in self.roots.viewitems(): self.add_tree(path, dev)
+
+	def add_tree(self, path, dev, files=False):
+		'Add watches for all directories under path, marking all files there as changed, if requested.'
+		dirs = [path]
+		while dirs:
+			path = dirs.pop()
+			with self.lock: # so that events won't be processed before wd is known
+				try: wd = inotify.check(inotify.libc.inotify_add_watch(self.fd, path, self._mask), path)
+				except OSError as err:
+					if err.errno in [errno.ENOENT, errno.ENOTDIR]: continue
+					if not self.wds_failed:
+						self.log.warning(force_unicode( 'Failed to add inotify watch ({}), changes'
+							' in this and some other dirs will only be found on full scan: {}'.format(err, path) ))
+						self.wds_failed = True
+					continue
+				self.wds[wd] = path, dev
+			try: entries = scandir(path) if scandir else os.listdir(path)
+			except (OSError, IOError): continue
+			for entry in entries:
+				try:
+					if scandir:
+						p, is_dir = entry.path, entry.is_dir(follow_symlinks=False)
+						fstat = entry.stat(follow_symlinks=False) if is_dir else None
+					else:
+						p = join(path, entry)
+						fstat = os.lstat(p)
+						is_dir = stat.S_ISDIR(fstat.st_mode)
+				except (IOError, OSError): continue
+				if not is_dir:
+					if files: self.changed(p)
+				elif p in self.roots or not self.check_filters(p + '/'): continue
+				elif self.xdev and fstat.st_dev != dev: continue
+				else: dirs.append(p)
+
+	def remove_tree(self, path):
+		prefix = path.rstrip('/') + '/'
+		with self.lock:
+			for wd, (p, dev) in self.wds.items():
+				if p != path and not p.startswith(prefix): continue
+				inotify.libc.inotify_rm_watch(self.fd, wd)
+				del self.wds[wd]
+
+	def _process(self, buff):
+		ev = self._ev
+		while buff:
+			wd, mask, cookie, name_len = ev.unpack_from(buff)
+			name, buff = buff[ev.size:ev.size + name_len].rstrip('\0'), buff[ev.size + name_len:]
+			if mask & IN_Q_OVERFLOW:
+				self.overflow = True
+				continue
+			with self.lock:
+				path, dev = self.wds.get(wd, (None, None))
+				if mask & IN_IGNORED: self.wds.pop(wd, None)
+			if not path or not name: continue
+			path = join(path, name)
+			if mask & IN_ISDIR:
+				if path in self.roots or not self.check_filters(path + '/'): continue
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					try: dev_new = os.lstat(path).st_dev
+					except OSError: continue
+					if not self.xdev or dev_new == dev: self.add_tree(path, dev, files=True)
+				elif mask & IN_MOVED_FROM: self.remove_tree(path)
+				continue
+			self.changed(path)
+
+
+class FanotifyWatch(FSWatch):
+	'''fanotify watch for files being modified on whole filesystems of root paths.
+		Requires CAP_SYS_ADMIN and linux 4.20+ (for FAN_MARK_FILESYSTEM),
+			only reports files written to, but doesn't need to set up anything for each directory.'''
+
+	_ev = struct.Struct('=IBBHQii') # struct fanotify_event_metadata
+
+	def _init(self):
+		import ctypes
+		libc = inotify.libc_init()
+		libc.fanotify_mark.argtypes = [ ctypes.c_int,
+			ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p ]
+		return inotify.check(libc.fanotify_init(
+			FAN_CLOEXEC | FAN_CLASS_NOTIF,
+			os.O_RDONLY | os.O_LARGEFILE | IN_CLOEXEC )) # IN_CLOEXEC = O_CLOEXEC
+
+	def _setup(self):
+		devs = set()
+		for path, dev in self.roots.viewitems():
+			if dev in devs: continue
+			inotify.check(inotify.libc.fanotify_mark( self.fd,
+				FAN_MARK_ADD | FAN_MARK_FILESYSTEM, FAN_MODIFY | FAN_CLOSE_WRITE, AT_FDCWD, path ), path)
+			devs.add(dev)
+
+	def _process(self, buff):
+		ev = self._ev
+		while len(buff) >= ev.size:
+			ev_len, ver, res, meta_len, mask, fd, pid = ev.unpack_from(buff)
+			buff = buff[ev_len:]
+			if mask & FAN_Q_OVERFLOW: self.overflow = True
+			if fd < 0: continue
+			try: path = os.readlink('/proc/self/fd/{}'.format(fd))
+			except OSError: continue
+			finally: os.close(fd)
+			if path.endswith(' (deleted)'): path = path[:-10]
+			if self.root(path): self.changed(path)
+
+
+def watcher(paths, xdev=True, check_filters=None, backend='auto'):
+	'''Returns FSWatch object for specified backend (fanotify, inotify or auto),
+		where "auto" picks fanotify (if available and with xdev=True), falling back to inotify.
+		fanotify watch doesn't descend into other filesystems, same as with xdev=True.'''
+	log = logging.getLogger('bitrot_scrubber.watch')
+	roots = dict()
+	for path in set(it.imap(realpath, paths)):
+		try: roots[path] = os.stat(path).st_dev
+		except (OSError, IOError):
+			log.info(force_unicode('Unable to access path to watch: {}'.format(path)))
+	if backend not in ['auto', 'fanotify', 'inotify']:
+		raise ValueError('Unknown fs watch backend: {!r}'.format(backend))
+	if backend == 'fanotify' or (backend == 'auto' and xdev):
+		try: return FanotifyWatch(roots, xdev, check_filters)
+		except (OSError, AttributeError) as err: # AttributeError - no such libc function
+			if backend == 'fanotify': raise
+			log.debug('Failed to init fanotify ({}), using inotify instead'.format(err))
+	return INotifyTreeWatch(roots, xdev, check_filters)
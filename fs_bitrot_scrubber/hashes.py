@@ -0,0 +1,60 @@
+#-*- coding: utf-8 -*-
+
+import functools as ft
+from time import time
+import hashlib
+
+
+# Hashes that are picked from optional third-party modules, if not available in hashlib.
+# Values are lists of (module, attribute) tuples, first importable one is used.
+backends_extra = dict(
+	blake2b=[('pyblake2', 'blake2b')],
+	blake2s=[('pyblake2', 'blake2s')],
+	blake3=[('blake3', 'blake3')],
+	xxh64=[('xxhash', 'xxh64')],
+	xxh3_64=[('xxhash', 'xxh3_64')],
+	xxh3_128=[('xxhash', 'xxh3_128'), ('xxhash', 'xxh128')] )
+
+# Hashes that are checked by "bench-hash" command by default, in addition to backends_extra ones
+backends_bench = ['md5', 'sha1', 'sha256', 'sha512']
+
+
+def _get_hashlib(name):
+	hashlib.new(name) # raises ValueError if not supported
+	checksum = getattr(hashlib, name, None)
+	return checksum if callable(checksum) else ft.partial(hashlib.new, name)
+
+def _get_module(mod, attr):
+	return getattr(__import__(mod), attr)
+
+def get(name):
+	'''Returns hash constructor (callable with optional
+		data argument) for a name, raising LookupError if it is not available.'''
+	candidates = [ft.partial(_get_hashlib, name)]\
+		+ list(ft.partial(_get_module, *spec) for spec in backends_extra.get(name, list()))
+	for get_checksum in candidates:
+		try:
+			checksum = get_checksum()
+			checksum('').digest() # make sure it works without extra parameters
+		except (ImportError, AttributeError, ValueError, TypeError): continue
+		return checksum
+	raise LookupError('Hash algorithm is not available: {!r}'.format(name))
+
+def available(names=None):
+	'Returns list of available hash names, out of the specified or known ones.'
+	if names is None: names = backends_bench + sorted(backends_extra)
+	names_ok = list()
+	for name in names:
+		try: get(name)
+		except LookupError: continue
+		names_ok.append(name)
+	return names_ok
+
+def bench(checksum, data, size):
+	'Returns rate (bytes/s) of hashing at least "size" bytes with checksum, fed in "data" chunks.'
+	digest, n, ts = checksum(), 0, time()
+	while n < size:
+		digest.update(data)
+		n += len(data)
+	digest.digest()
+	return n / max(time() - ts, 1e-6)
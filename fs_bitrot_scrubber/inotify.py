@@ -0,0 +1,95 @@
+#-*- coding: utf-8 -*-
+
+import os, errno, struct, select, threading
+
+# /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+libc = get_errno = None
+
+def libc_init():
+	global libc, get_errno
+	if not libc: # only import and initialize ctypes if used
+		import ctypes, ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		get_errno = ctypes.get_errno
+	return libc
+
+def check(res, *err_args):
+	'Raises OSError with errno for negative libc call result.'
+	if res < 0:
+		err = get_errno()
+		raise OSError(err, os.strerror(err), *err_args)
+	return res
+
+
+class INotify(object):
+	'''Watches files for changes via inotify, with events read by a background thread,
+		so that checking whether watched file has changed doesn't need any syscalls.'''
+
+	_ev = struct.Struct('=iIII') # struct inotify_event, followed by name
+
+	def __init__(self, mask=IN_MODIFY | IN_ATTRIB):
+		libc_init()
+		self.fd = check(libc.inotify_init1(IN_CLOEXEC))
+		self.mask, self.watches, self.changed = mask, dict(), set()
+		self.lock = threading.Lock() # add/remove can be called from different threads
+		self.ctl_r, self.ctl_w = os.pipe()
+		self.thread = threading.Thread(target=self._run, name='INotify')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def add(self, path):
+		'Returns watch descriptor for path, to use with is_changed() and remove().'
+		with self.lock:
+			wd = check(libc.inotify_add_watch(self.fd, path, self.mask), path)
+			self.watches[wd] = self.watches.get(wd, 0) + 1 # same wd for same inode
+		return wd
+
+	def is_changed(self, wd):
+		return wd in self.changed
+
+	def remove(self, wd):
+		with self.lock:
+			self.watches[wd] -= 1
+			if self.watches[wd] > 0: return
+			del self.watches[wd]
+			libc.inotify_rm_watch(self.fd, wd)
+			self.changed.discard(wd)
+
+	def _run(self):
+		while True:
+			try: rlist, wlist, xlist = select.select([self.fd, self.ctl_r], [], [])
+			except select.error as err:
+				if err.args[0] == errno.EINTR: continue
+				raise
+			if self.ctl_r in rlist: break
+			try: buff = os.read(self.fd, 64 * 2**10)
+			except OSError as err:
+				if err.errno == errno.EINTR: continue
+				raise
+			while buff:
+				wd, mask, cookie, name_len = self._ev.unpack_from(buff)
+				buff = buff[self._ev.size + name_len:]
+				if mask & IN_IGNORED: self.changed.discard(wd)
+				elif wd in self.watches: self.changed.add(wd)
+
+	def close(self):
+		if self.fd is None: return
+		os.write(self.ctl_w, '\0')
+		self.thread.join()
+		for fd in self.fd, self.ctl_r, self.ctl_w: os.close(fd)
+		self.fd = None
@@ -0,0 +1,179 @@
+#-*- coding: utf-8 -*-
+
+from time import time, sleep
+import os, json, tempfile, threading
+
+
+# Descriptions for known counters, also used as HELP lines in prometheus format
+counters_info = dict(
+	files_scanned='Number of files scanned on filesystem.',
+	files_checked='Number of files that were read and verified (or hashed for the first time).',
+	files_new='Number of files checksummed for the first time.',
+	files_changed='Number of files with legitimate changes (contents and ctime/mtime).',
+	files_bitrot='Number of files with unmarked changes (bitrot) detected.',
+	files_skipped='Number of files that were changing while being read, skipped for now.',
+	files_failed='Number of files that failed to be read (e.g. I/O errors), skipped for now.',
+	files_moved='Number of new paths matched to moved files or checksum xattr tags, instead of hashed as new.',
+	files_linked='Number of hardlinks that got check results from other path to the same inode.',
+	bytes_read='Number of bytes read from files that were checked.',
+	bytes_sparse='Number of bytes in holes of sparse files, which were skipped instead of read.' )
+
+# Descriptions for phases, time of which is tracked by timers,
+#  with number of timed calls exported as well, e.g. number of db queries/commits
+timers_info = dict(
+	walk='Walking filesystem tree (file_list).',
+	scan='Updating metadata db with scanned files (metadata_check).',
+	clean='Removing files that were not found on scan from metadata db.',
+	queue='Picking next file to check (get_file_to_scrub), incl. opening it.',
+	read_io='Reading file contents, or waiting for read-ahead thread.',
+	read_hash='Hashing file contents.',
+	db_query='Running metadata db queries, incl. fetching results.',
+	db_commit='Committing metadata db changes.',
+	parity='Updating and verifying parity data for metadata db.',
+	sleep_scan='Sleeping due to rate limit on scan.',
+	sleep_read='Sleeping due to rate limit on reads.' )
+
+# Descriptions for gauges returned by "collect" function
+gauges_info = dict(
+	generation='Current scrub generation number.',
+	queue_files='Number of files left to check in current generation, by priority class.',
+	queue_bytes='Size of files left to check in current generation, by priority class.',
+	sla_overdue_files='Number of files not checked within SLA max age, by max age.',
+	sla_overdue_bytes='Size of files not checked within SLA max age, by max age.',
+	sla_due_files='Number of files that have to be checked in the next run to stay within SLA max age.',
+	sla_ok='Whether next runs are projected to check all files within SLA max age (1) or not (0).' )
+
+
+class Timer(object):
+	'Context manager to add time spent in it to a Metrics timer, cheaper than @contextmanager one.'
+	__slots__ = 'metrics', 'name', 'ts'
+
+	def __init__(self, metrics, name): self.metrics, self.name = metrics, name
+	def __enter__(self): self.ts = time()
+	def __exit__(self, *err): self.metrics.add_time(self.name, time() - self.ts)
+
+
+class Metrics(object):
+	'''Thread-safe counters and timers for different phases of scrub/watch runs.
+		Values are stored separately for each thread, to update these without locking,
+			and are merged together in stats(), which also folds in ones from finished threads.
+		Can be exported to a file in prometheus text format (for node_exporter
+			textfile collector) or as JSON, at the end of the run and/or every "interval" seconds.
+		collect - function returning {name: {labels_tuple: value}} dict of extra gauges
+			(e.g. queue backlog), called from the thread doing export() on each one.'''
+
+	prefix = 'fs_bitrot_scrubber'
+
+	def __init__(self, path=None, fmt='prometheus', interval=None, collect=None):
+		assert fmt in ['prometheus', 'json'], fmt
+		self.path, self.fmt, self.interval, self.collect = path, fmt, interval, collect
+		self.lock, self.local, self.threads = threading.Lock(), threading.local(), list()
+		self.counters, self.timers = dict(), dict() # values from finished threads
+		self.ts_start = self.ts_export = time()
+
+	def _thread_stats(self):
+		'Returns (counters, timers) dicts for the current thread.'
+		try: return self.local.stats
+		except AttributeError:
+			stats = self.local.stats = dict(), dict()
+			with self.lock: self.threads.append((threading.current_thread(), stats))
+			return stats
+
+	def add(self, name, val=1):
+		counters = self._thread_stats()[0]
+		counters[name] = counters.get(name, 0) + val
+
+	def add_time(self, name, delta):
+		timers = self._thread_stats()[1]
+		n, total = timers.get(name, (0, 0))
+		timers[name] = n + 1, total + delta
+
+	def timer(self, name): return Timer(self, name)
+
+	def timed_iter(self, name, iterable):
+		'Iterate over iterable, counting time spent to get each item towards "name" timer.'
+		iterable = iter(iterable)
+		while True:
+			ts = time()
+			try: val = next(iterable)
+			except StopIteration: break
+			finally: self.add_time(name, time() - ts)
+			yield val
+
+	def sleep(self, name, delay, interrupt=None):
+		'interrupt - threading.Event to wait on instead, returning early when it is set.'
+		if delay <= 0: return
+		if not interrupt: sleep(delay)
+		else:
+			ts = time()
+			interrupt.wait(delay)
+			delay = time() - ts
+		self.add_time(name, delay)
+
+	def stats(self):
+		'Returns dict with snapshot of all counters, timers and collected gauges.'
+		def merge(counters, timers, stats):
+			for k, v in stats[0].copy().viewitems(): counters[k] = counters.get(k, 0) + v
+			for k, (n, total) in stats[1].copy().viewitems():
+				n0, total0 = timers.get(k, (0, 0))
+				timers[k] = n0 + n, total0 + total
+		with self.lock:
+			for thread, stats in list(self.threads):
+				if thread.is_alive(): continue
+				merge(self.counters, self.timers, stats)
+				self.threads.remove((thread, stats))
+			counters, timers = self.counters.copy(), self.timers.copy()
+			for thread, stats in self.threads: merge(counters, timers, stats)
+		ts = time()
+		return dict( ts=ts, ts_start=self.ts_start, uptime=ts - self.ts_start,
+			counters=counters, timers=dict((k, dict(count=n, seconds=total))
+				for k, (n, total) in timers.viewitems()),
+			gauges=self.collect() if self.collect else dict() )
+
+	def format_json(self, stats):
+		stats = stats.copy()
+		stats['gauges'] = dict(
+			(name, list(dict(labels, value=v) for labels, v in sorted(vals.viewitems())))
+			for name, vals in stats['gauges'].viewitems() )
+		return json.dumps(stats, indent=2, sort_keys=True) + '\n'
+
+	def format_prometheus(self, stats):
+		lines, p = list(), self.prefix
+		def metric(name, mtype, help, vals):
+			lines.extend([ '# HELP {}_{} {}'.format(p, name, help),
+				'# TYPE {}_{} {}'.format(p, name, mtype) ])
+			for labels, val in sorted(vals):
+				labels = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+				val = repr(val) if isinstance(val, float) else str(int(val)) # no "L" suffix for longs
+				lines.append('{}_{}{} {}'.format(p, name, labels and '{{{}}}'.format(labels), val))
+		metric('start_time_seconds', 'gauge', 'Time when process was started.', [((), stats['ts_start'])])
+		metric('last_update_seconds', 'gauge', 'Time when these metrics were exported.', [((), stats['ts'])])
+		for k in sorted(set(counters_info).union(stats['counters'])):
+			metric( '{}_total'.format(k), 'counter',
+				counters_info.get(k, k), [((), stats['counters'].get(k, 0))] )
+		timers = sorted( (k, stats['timers'].get(k, dict(count=0, seconds=0)))
+			for k in set(timers_info).union(stats['timers']) )
+		metric( 'phase_seconds_total', 'counter',
+			'Time spent in each phase of operation, see also phase_calls_total.',
+			list(((('phase', k),), t['seconds']) for k, t in timers) )
+		metric( 'phase_calls_total', 'counter', 'Number of times each phase was entered.',
+			list(((('phase', k),), t['count']) for k, t in timers) )
+		for name, vals in sorted(stats['gauges'].viewitems()):
+			metric(name, 'gauge', gauges_info.get(name, name), vals.viewitems())
+		return '\n'.join(lines) + '\n'
+
+	def export(self, force=False):
+		'''Write metrics to a file, if path is set and either
+			"force" is passed or "interval" seconds have passed since the last time.
+			File is replaced atomically, so that it's never read while being written.'''
+		if not self.path: return
+		ts = time()
+		if not force and (not self.interval or ts - self.ts_export < self.interval): return
+		self.ts_export, stats = ts, self.stats()
+		data = self.format_json(stats) if self.fmt == 'json' else self.format_prometheus(stats)
+		path_dir, name = os.path.split(self.path)
+		with tempfile.NamedTemporaryFile( 'w',
+				dir=path_dir or '.', prefix=name + '.', delete=False ) as tmp:
+			tmp.write(data)
+		os.chmod(tmp.name, 0o644)
+		os.rename(tmp.name, self.path)
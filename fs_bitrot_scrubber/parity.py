@@ -0,0 +1,271 @@
+#-*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from binascii import hexlify, unhexlify
+from contextlib import closing
+import os, struct, random, sqlite3, logging, hashlib
+
+try: import zfec
+except ImportError: zfec = None
+
+
+class DBCheckError(Exception): pass
+
+
+def xor_blocks(blocks, size):
+	'Returns XOR of all strings in "blocks", which should be of the same "size".'
+	n = 0
+	for block in blocks: n ^= int(hexlify(block), 16)
+	return unhexlify('{:x}'.format(n).zfill(size * 2))
+
+def parity_encode(blocks, parity):
+	'Returns list of "parity" number of parity blocks for a list of same-size data blocks.'
+	if parity == 1: return [xor_blocks(blocks, len(blocks[0]))]
+	k = len(blocks)
+	return zfec.Encoder(k, k + parity).encode(blocks, range(k, k + parity))
+
+def parity_decode(blocks, parity_blocks):
+	'''Returns list of data blocks with missing ones (None values) restored from parity blocks.
+		Up to len(parity_blocks) missing data/parity blocks can be restored.'''
+	k, size = len(blocks), len(next(b for b in it.chain(blocks, parity_blocks) if b is not None))
+	if len(parity_blocks) == 1:
+		n, = (n for n, b in enumerate(blocks) if b is None)
+		blocks = list(blocks)
+		blocks[n] = xor_blocks((b for b in it.chain(blocks, parity_blocks) if b is not None), size)
+		return blocks
+	shares = list((n, b) for n, b in enumerate(it.chain(blocks, parity_blocks)) if b is not None)[:k]
+	return zfec.Decoder(k, k + len(parity_blocks))\
+		.decode(map(op.itemgetter(1), shares), map(op.itemgetter(0), shares))
+
+def wal_chunks(path, chunk_size):
+	'Returns set of numbers of db file chunks for all pages in sqlite WAL file.'
+	chunks = set()
+	with open(path, 'rb') as src:
+		header = src.read(32)
+		if len(header) < 32: return chunks
+		magic, ver, page_size, seq, salt1, salt2 = struct.unpack('>6I', header[:24])
+		if page_size == 1: page_size = 2**16 # same as in db header
+		for n in it.count():
+			src.seek(32 + n * (24 + page_size))
+			frame = src.read(24)
+			if len(frame) < 24: break
+			page, commit_size, s1, s2 = struct.unpack('>4I', frame[:16])
+			if (s1, s2) != (salt1, salt2): break # old frames, from before WAL reset
+			offset = (page - 1) * page_size
+			chunks.update(xrange(offset // chunk_size, (offset + page_size - 1) // chunk_size + 1))
+	return chunks
+
+
+class DBParity(object):
+	'''Checksums for fixed-size chunks of a (metadata db) file and parity data
+			for groups of these chunks, stored in a separate sqlite db,
+			to detect and repair corruption of the file.
+		Checksums/parity are only updated for specified (e.g. changed) chunks in update().
+		parity - number of parity chunks for each group of group_size
+			chunks, where 1 - xor, >1 - reed-solomon codes (requires zfec module), 0 - none.
+		If any of these parameters change, data for the file is rebuilt on the next update().'''
+
+	# chunks - checksums of data chunks
+	# parity - parity chunks for each group of data chunks, with their checksums
+	# pending - chunks that are about to change in the file, which can't be verified
+	_db_init = '''
+		CREATE TABLE IF NOT EXISTS chunks (
+			n INTEGER PRIMARY KEY ON CONFLICT REPLACE NOT NULL,
+			checksum BLOB NOT NULL
+		);
+		CREATE TABLE IF NOT EXISTS parity (
+			grp INT NOT NULL,
+			n INT NOT NULL,
+			data BLOB NOT NULL,
+			checksum BLOB NOT NULL,
+			PRIMARY KEY (grp, n) ON CONFLICT REPLACE
+		);
+		CREATE TABLE IF NOT EXISTS pending (
+			n INTEGER PRIMARY KEY ON CONFLICT IGNORE NOT NULL
+		);
+		CREATE TABLE IF NOT EXISTS meta (
+			var TEXT PRIMARY KEY ON CONFLICT REPLACE NOT NULL,
+			val TEXT NOT NULL
+		);
+	'''
+	_db_magic = 'SQLite format 3\0'
+
+	checksum = hashlib.sha256
+
+	def __init__(self, path, src_path, chunk_size=2**20, group_size=16, parity=1, log=None):
+		if parity > 1 and not zfec:
+			raise ImportError('zfec module is required for more than one parity chunk per group')
+		self.log = logging.getLogger('bitrot_scrubber.DBParity') if not log else log
+		self.src_path, self.params = src_path, (int(chunk_size), int(group_size), int(parity))
+		self._db = sqlite3.connect(path)
+		self._db.row_factory, self._db.text_factory = sqlite3.Row, str
+		with self._db as db: db.executescript(self._db_init)
+		with closing(self._db.execute('SELECT var, val FROM meta')) as c:
+			meta = dict((row['var'], row['val']) for row in c)
+		# Stored parameters are used until update(), as these were used to create stored data
+		self.size = int(meta['size']) if 'size' in meta else None
+		self.chunk_size, self.group_size, self.parity = self.params\
+			if 'params' not in meta else tuple(it.imap(int, meta['params'].split(':')))
+
+	@classmethod
+	def is_parity_db(cls, path):
+		with open(path, 'rb') as src: return src.read(len(cls._db_magic)) == cls._db_magic
+
+	def close(self):
+		if self._db:
+			self._db.close()
+			self._db = None
+
+	def __enter__(self): return self
+	def __exit__(self, *err): self.close()
+
+
+	def _chunk_count(self, size):
+		return (size + self.chunk_size - 1) // self.chunk_size
+
+	def _chunk_read(self, src, n, pad=None):
+		src.seek(n * self.chunk_size)
+		chunk = src.read(self.chunk_size)
+		if pad: chunk = chunk.ljust(pad, '\0')
+		return chunk
+
+	def _group_chunks(self, src, grp, size):
+		'''Returns list of data chunks for a group, padded to the
+			longest one there, with missing ones (past EOF) as zeroes.'''
+		pad = min(self.chunk_size, size - grp * self.group_size * self.chunk_size)
+		count = self._chunk_count(size)
+		return list( (self._chunk_read(src, n, pad=pad) if n < count else '\0' * pad)
+			for n in xrange(grp * self.group_size, (grp + 1) * self.group_size) )
+
+	def get_pending(self):
+		with closing(self._db.execute('SELECT n FROM pending')) as c:
+			return set(row['n'] for row in c)
+
+	def add_pending(self, chunks):
+		'Mark chunks that are about to change, so that these are not checked until update().'
+		with self._db as db: db.executemany('INSERT INTO pending (n) VALUES (?)', ((n,) for n in chunks))
+
+	def update(self, chunks=None):
+		'''Update checksums and parity data for specified chunks of the file and all pending ones.
+			All data is rebuilt if chunks=None, parameters have changed or if there is none.'''
+		size = os.stat(self.src_path).st_size
+		if chunks is None or self.size is None or self.params != (self.chunk_size, self.group_size, self.parity):
+			self.chunk_size, self.group_size, self.parity = self.params
+			chunks = None
+		count = self._chunk_count(size)
+		if chunks is not None:
+			chunks = self.get_pending() | set(chunks)
+			if size != self.size: # padding/chunks changed in last groups
+				chunks.update([count - 1, self._chunk_count(self.size) - 1])
+		else: chunks = xrange(count)
+		groups = set()
+		with self._db as db, open(self.src_path, 'rb') as src:
+			if isinstance(chunks, xrange): db.execute('DELETE FROM parity')
+			db.execute('DELETE FROM chunks WHERE n >= ?', (count,))
+			db.execute('DELETE FROM parity WHERE grp >= ?', (-(-count // self.group_size),))
+			for n in chunks:
+				if not 0 <= n < count: continue
+				db.execute( 'INSERT INTO chunks (n, checksum) VALUES (?, ?)',
+					(n, self.checksum(self._chunk_read(src, n)).digest()) )
+				groups.add(n // self.group_size)
+			for grp in sorted(groups) if self.parity else list():
+				for n, data in enumerate(parity_encode(self._group_chunks(src, grp, size), self.parity)):
+					db.execute( 'INSERT INTO parity (grp, n, data, checksum) VALUES (?, ?, ?, ?)',
+						(grp, n, sqlite3.Binary(data), self.checksum(data).digest()) )
+			db.execute('DELETE FROM pending')
+			db.execute("INSERT INTO meta (var, val) VALUES ('size', ?)", (str(size),))
+			db.execute( "INSERT INTO meta (var, val) VALUES ('params', ?)",
+				(':'.join(it.imap(str, self.params)),) )
+		self.size = size
+
+	def verify(self, sample=None, repair=True):
+		'''Check file chunks against stored checksums, repairing corrupted ones if possible.
+			sample - fraction of randomly-picked chunks to check (0-1.0), all of these by default.
+			Returns list of repaired chunks, raises DBCheckError for unrecoverable corruption.'''
+		if self.size is None: return list() # no data to check against
+		size, pending = os.stat(self.src_path).st_size, self.get_pending()
+		if size != self.size:
+			if not pending: # can be in the middle of update() from other pid
+				raise DBCheckError( 'DB check failed - file size does not'
+					' match the one it had on last update ({} != {})'.format(size, self.size) )
+			size = min(size, self.size)
+		count = self._chunk_count(size)
+		chunks = xrange(count)
+		if sample is not None and sample < 1:
+			chunks = sorted(random.sample(chunks, min(count, int(count * sample) + 1)))
+		bad = list()
+		with open(self.src_path, 'rb') as src:
+			for n in chunks:
+				if n in pending: continue
+				with closing(self._db.execute('SELECT checksum FROM chunks WHERE n = ?', (n,))) as c:
+					row = c.fetchone()
+				if not row or self.checksum(self._chunk_read(src, n)).digest() != row['checksum']:
+					bad.append(n)
+		if not bad: return list()
+		self.log.warning('Detected corrupted chunks in db file {}: {}'.format(self.src_path, bad))
+
+		fixed, failed = dict(), list()
+		with open(self.src_path, 'rb') as src:
+			for grp, grp_bad in it.groupby(bad, key=lambda n: n // self.group_size):
+				grp_bad = list(grp_bad)
+				try: fixed.update(self._restore(src, grp, grp_bad, count, pending))
+				except DBCheckError as err:
+					self.log.error(str(err))
+					failed.extend(grp_bad)
+		if failed:
+			raise DBCheckError( 'DB check failed - unable to restore'
+				' corrupted chunks of {}: {}'.format(self.src_path, failed) )
+		if repair:
+			with open(self.src_path, 'r+b') as dst:
+				for n, chunk in sorted(fixed.viewitems()):
+					dst.seek(n * self.chunk_size)
+					dst.write(chunk)
+				dst.flush()
+				os.fsync(dst.fileno())
+			self.log.warning('Repaired corrupted chunks in db file {}: {}'.format(self.src_path, sorted(fixed)))
+		return sorted(fixed)
+
+	def verify_parity(self, repair=True):
+		'''Check stored parity data against its checksums, rebuilding corrupted
+				parity chunks from file data, which should be verified before that.
+			Returns list of groups with corrupted parity data.'''
+		if not self.parity or self.size is None: return list()
+		bad, groups = set(), -(-self._chunk_count(self.size) // self.group_size)
+		with closing(self._db.execute('SELECT grp, n, data, checksum FROM parity')) as c:
+			seen = set()
+			for row in c:
+				seen.add((row['grp'], row['n']))
+				if self.checksum(bytes(row['data'])).digest() != row['checksum']: bad.add(row['grp'])
+		bad.update( grp for grp in xrange(groups)
+			if any((grp, n) not in seen for n in xrange(self.parity)) )
+		if bad:
+			self.log.warning('Detected corrupted parity data for chunk groups: {}'.format(sorted(bad)))
+			if repair: self.update(list(grp * self.group_size for grp in bad))
+		return sorted(bad)
+
+	def _restore(self, src, grp, grp_bad, count, pending):
+		'Returns {chunk: data} for restored data of corrupted chunks in a group.'
+		grp_chunks = xrange(grp * self.group_size, (grp + 1) * self.group_size)
+		if not self.parity or pending.intersection(grp_chunks):
+			raise DBCheckError('No up-to-date parity data for chunks: {}'.format(grp_bad))
+		chunks = self._group_chunks(src, grp, self.size)
+		for n in grp_bad: chunks[n - grp_chunks[0]] = None
+		parity = [None] * self.parity
+		with closing(self._db.execute( 'SELECT n, data, checksum'
+				' FROM parity WHERE grp = ?', (grp,) )) as c:
+			for row in c:
+				data = bytes(row['data'])
+				if row['n'] < self.parity and self.checksum(data).digest() == row['checksum']:
+					parity[row['n']] = data
+		if sum(1 for b in it.chain(chunks, parity) if b is None) > self.parity:
+			raise DBCheckError('Too many corrupted chunks/parity data to restore: {}'.format(grp_bad))
+		chunks, fixed = parity_decode(chunks, parity), dict()
+		for n in grp_bad:
+			chunk = chunks[n - grp_chunks[0]]
+			chunk = chunk[:self.size - n * self.chunk_size] # strip padding
+			with closing(self._db.execute('SELECT checksum FROM chunks WHERE n = ?', (n,))) as c:
+				row = c.fetchone()
+			if not row or self.checksum(chunk).digest() != row['checksum']:
+				raise DBCheckError('Restored chunk data does not match checksum: {}'.format(n))
+			fixed[n] = chunk
+		return fixed
@@ -0,0 +1,135 @@
+#-*- coding: utf-8 -*-
+
+import os, re, sre_parse, sre_constants
+
+
+_re_type = type(re.compile(''))
+
+_re_at_start = [ (sre_constants.AT, sre_constants.AT_BEGINNING),
+	(sre_constants.AT, sre_constants.AT_BEGINNING_STRING) ]
+
+def _pattern_refs(data):
+	'Returns True if parsed regexp (sre_parse data) has any backreferences to groups.'
+	for op, av in data:
+		if op in [sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS]: return True
+		for v in av if isinstance(av, (tuple, list)) else [av]:
+			if isinstance(v, sre_parse.SubPattern): v = [v]
+			if isinstance(v, list) and any(_pattern_refs(p) for p in v if isinstance(p, sre_parse.SubPattern)):
+				return True
+	return False
+
+def _trie_build(items):
+	'''Returns radix trie node for a list of (string, rule) tuples,
+		where node is (rule, {char: (label, node)}) with rule for the first string ending there.'''
+	ends = list(rule for s, rule in items if not s)
+	edges, groups = dict(), dict()
+	for s, rule in items:
+		if s: groups.setdefault(s[0], list()).append((s, rule))
+	for c, group in groups.viewitems():
+		label = os.path.commonprefix(list(s for s, rule in group))
+		edges[c] = label, _trie_build(list((s[len(label):], rule) for s, rule in group))
+	return min(ends) if ends else None, edges
+
+
+class PathFilter(object):
+	'''Compiled list of include/exclude rules for paths, where first matching rule wins.
+		Rules are (include, pattern) tuples with python regexp patterns (strings or compiled),
+			matched via re.search(), or just patterns, which are treated as exclude rules.
+		Patterns anchored to start of the path with literal prefix (e.g. "^/srv/video/") are
+			checked via prefix trie, and the rest are merged into few alternation regexps, so that
+			matching does not have to loop over all rules for each path, with same results.'''
+
+	# py2 re module can't compile patterns with more groups (100, incl. implicit group 0)
+	group_limit = 99
+
+	def __init__(self, rules=None, default=True):
+		self.default, self.rules = default, list()
+		literals, regexps = list(), list()
+		for n, rule in enumerate(rules or list()):
+			try: include, pat = rule
+			except (TypeError, ValueError): include, pat = False, rule
+			if not isinstance(pat, _re_type): pat = re.compile(pat)
+			self.rules.append((include, pat))
+			literal = self._pattern_literal(pat)
+			if literal is not None: literals.append((literal, n))
+			else: regexps.append((n, pat))
+		self.trie = _trie_build(literals) if literals else None
+
+		# Sequence of (first_rule, regexp, {group: rule}) tuples, with None instead of group map
+		#  for regexps that can't be merged (flags, backrefs, named groups), checked in order
+		self.regexps, chunk, chunk_groups = list(), list(), 0
+		for n, pat in regexps:
+			if self._pattern_mergeable(pat):
+				if chunk_groups + pat.groups + 1 <= self.group_limit:
+					chunk.append((n, pat))
+					chunk_groups += pat.groups + 1
+					continue
+				self._regexps_merge(chunk)
+				chunk, chunk_groups = [(n, pat)], pat.groups + 1
+				continue
+			self._regexps_merge(chunk)
+			chunk, chunk_groups = list(), 0
+			self.regexps.append((n, pat, None))
+		self._regexps_merge(chunk)
+
+	# Only byte-string patterns without flags are optimized, as paths are bytes as well
+
+	def _pattern_literal(self, pat):
+		'Returns literal prefix string for "^prefix" pattern, or None if it is not such pattern.'
+		if not isinstance(pat.pattern, bytes) or pat.flags & ~re.UNICODE: return
+		data = sre_parse.parse(pat.pattern).data
+		if not data or data[0] not in _re_at_start: return
+		if any(op != sre_constants.LITERAL for op, av in data[1:]): return
+		return ''.join(chr(av) for op, av in data[1:])
+
+	def _pattern_mergeable(self, pat):
+		if not isinstance(pat.pattern, bytes) or pat.flags & ~re.UNICODE or pat.groupindex: return False
+		return not _pattern_refs(sre_parse.parse(pat.pattern).data)
+
+	def _regexps_merge(self, chunk):
+		if not chunk: return
+		if len(chunk) == 1:
+			self.regexps.append(chunk[0] + (None,))
+			return
+		# Each pattern is prefixed by non-greedy "any chars" and matched from the start of the path,
+		#  so that alternatives are tried in order, same as re.search() with each pattern would,
+		#  instead of returning whichever one matches closest to the start of the path
+		# Patterns anchored to the start of the path don't need such prefix
+		parts = list()
+		for n, pat in chunk:
+			data = sre_parse.parse(pat.pattern).data
+			anchored = bool(data) and data[0] in _re_at_start
+			parts.append('({}(?:{}))'.format('' if anchored else r'[\s\S]*?', pat.pattern))
+		pat = re.compile('|'.join(parts))
+		groups, group = dict(), 1
+		for n, pat_rule in chunk:
+			groups[group] = n
+			group += pat_rule.groups + 1
+		self.regexps.append((chunk[0][0], pat, groups))
+
+	def match(self, path):
+		'Returns index of the first rule matching path, or None.'
+		found, node, pos = None, self.trie, 0
+		while node:
+			rule, edges = node
+			if rule is not None and (found is None or rule < found): found = rule
+			try: label, node = edges[path[pos]]
+			except (KeyError, IndexError): break
+			if not path.startswith(label, pos): break
+			pos += len(label)
+		for n, pat, groups in self.regexps:
+			if found is not None and n > found: break
+			if groups is None:
+				if not pat.search(path): continue
+				return n
+			m = pat.match(path)
+			if not m: continue
+			# Outer group of the matched alternative is closed last
+			n = groups[m.lastindex]
+			return n if found is None or n < found else found
+		return found
+
+	def __call__(self, path):
+		'Returns whether path should be included.'
+		n = self.match(path)
+		return self.default if n is None else self.rules[n][0]
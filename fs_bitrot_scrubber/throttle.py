@@ -0,0 +1,101 @@
+#-*- coding: utf-8 -*-
+
+from time import time
+import os, logging
+
+
+def io_pressure(path='/proc/pressure/io'):
+	'Returns total microseconds that some tasks were stalled on io (PSI), or None if not available.'
+	try:
+		with open(path) as src:
+			for line in src:
+				if not line.startswith('some '): continue
+				return int(dict(v.split('=', 1) for v in line.split()[1:])['total'])
+	except (OSError, IOError, KeyError, ValueError): return None
+
+def disk_stats(disks=None, path='/proc/diskstats'):
+	'''Returns {disk: (ios, io_ms, ticks_ms)} from /proc/diskstats, where ios - number
+			of completed reads/writes, io_ms - time spent on these, ticks_ms - time disk was busy.
+		If "disks" is not specified, all whole-disk devices (from /sys/block, except loop/ram) are returned.'''
+	if disks is None:
+		try: disks = set(os.listdir('/sys/block'))
+		except OSError: disks = set()
+		disks = set(d for d in disks if not d.startswith(('loop', 'ram', 'zram')))
+	stats = dict()
+	try:
+		with open(path) as src:
+			for line in src:
+				line = line.split()
+				if len(line) < 14 or line[2] not in disks: continue
+				rd, rd_ms, wr, wr_ms, ticks = (int(line[n]) for n in [3, 6, 7, 10, 12])
+				stats[line[2]] = rd + wr, rd_ms + wr_ms, ticks
+	except (OSError, IOError, ValueError): pass
+	return stats
+
+
+class AdaptiveBucket(object):
+	'''Token bucket (same interface as core.token_bucket generator)
+			with rate adjusted between rate_min and rate_max,
+			depending on io pressure (PSI) and disk utilization/latency.
+		Rate starts at rate_min, backing off (multiplicative decrease)
+			when any of psi_max (%), util_max (%) or await_max (ms) thresholds
+			is exceeded, and ramping up when all are below half of these.
+		Rate is not changed if none of the thresholds can be checked.
+		Checks are done every check_interval seconds, using stats for that interval.
+		"disks" is a list of /proc/diskstats names to check, None - all disks.
+		Note that scrub itself contributes to all these values.'''
+
+	backoff, ramp_up = 0.5, 1.5
+
+	def __init__( self, metric, rate_min, rate_max, burst=1.0, check_interval=5.0,
+			psi_max=None, util_max=None, await_max=None, disks=None, log=None ):
+		self.log = logging.getLogger('bitrot_scrubber.throttle') if not log else log
+		self.metric, self.disks = metric, disks
+		self.rate_min, self.rate_max = rate_min, max(rate_min, rate_max)
+		self.burst, self.check_interval = burst, check_interval
+		self.psi_max, self.util_max, self.await_max = psi_max, util_max, await_max
+		self.rate, self.tokens, self.ts_sync = rate_min, burst, time()
+		self.stats = self._stats()
+
+	def _stats(self):
+		disks = None if self.disks is None else set(self.disks)
+		return time(), io_pressure(), disk_stats(disks)
+
+	def _check(self):
+		'Returns dict of psi/util/await values since the last check.'
+		(ts0, psi0, disks0), self.stats = self.stats, self._stats()
+		ts1, psi1, disks1 = self.stats
+		delta, res = max(ts1 - ts0, 1e-3), dict()
+		if psi0 is not None and psi1 is not None:
+			res['psi'] = (psi1 - psi0) / (delta * 1e4) # us -> %
+		for disk in set(disks0).intersection(disks1):
+			(ios0, io_ms0, ticks0), (ios1, io_ms1, ticks1) = disks0[disk], disks1[disk]
+			res['util'] = max(res.get('util', 0), (ticks1 - ticks0) / (delta * 10.0)) # ms -> %
+			if ios1 > ios0: res['await'] = max(res.get('await', 0), (io_ms1 - io_ms0) / float(ios1 - ios0))
+		return res
+
+	def _adjust(self):
+		stats, rate = self._check(), self.rate
+		limits = list( (k, stats[k], v) for k, v in
+			[('psi', self.psi_max), ('util', self.util_max), ('await', self.await_max)]
+			if v is not None and k in stats )
+		if not limits: action = 'keeping' # nothing to check against
+		elif any(val > v_max for k, val, v_max in limits):
+			rate, action = max(self.rate_min, rate * self.backoff), 'backing off'
+		elif all(val < v_max / 2.0 for k, val, v_max in limits):
+			rate, action = min(self.rate_max, rate * self.ramp_up), 'ramping up'
+		else: action = 'keeping'
+		self.log.debug('Adaptive rate limit ({}{}): {} - {}, rate: {:.1f} -> {:.1f}/s'.format(
+			self.metric, ', disks: {}'.format(', '.join(self.disks)) if self.disks else '',
+			', '.join('{}={:.1f}'.format(k, stats[k]) for k in sorted(stats)) or 'no stats',
+			action, self.rate, rate ))
+		self.rate = rate
+
+	def send(self, val):
+		'Returns delay (seconds) to wait before next operation, or None.'
+		ts = time()
+		if ts - self.stats[0] >= self.check_interval: self._adjust()
+		self.ts_sync, self.tokens = ts, min(self.burst, self.tokens + (ts - self.ts_sync) * self.rate)
+		self.tokens -= val
+		if self.tokens >= 0: return None
+		return -self.tokens / self.rate
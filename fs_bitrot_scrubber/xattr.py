@@ -0,0 +1,38 @@
+#-*- coding: utf-8 -*-
+
+import os, errno
+
+from fs_bitrot_scrubber import inotify
+
+# Errors for files/filesystems that don't have xattr or don't support these
+xattr_missing = errno.ENODATA, errno.ENOTSUP, errno.EOPNOTSUPP
+
+ctypes = None
+
+def xattr_get(path_or_fd, name, size=1024):
+	'''Returns value of extended attribute (not following symlinks),
+		or None if file doesn't have it or filesystem doesn't support these.'''
+	global ctypes
+	if not ctypes: import ctypes
+	libc, buff = inotify.libc_init(), ctypes.create_string_buffer(size)
+	if isinstance(path_or_fd, (int, long)): res = libc.fgetxattr(path_or_fd, name, buff, size)
+	else: res = libc.lgetxattr(path_or_fd, name, buff, size)
+	try: return buff.raw[:inotify.check(res)]
+	except OSError as err:
+		if err.errno in xattr_missing: return
+		raise
+
+def xattr_set(fd, name, value):
+	inotify.check(inotify.libc_init().fsetxattr(fd, name, value, len(value), 0))
+
+
+def tag_pack(checksum, algo, block_size, size, mtime):
+	'Returns xattr value to store checksum of the file with.'
+	return '{} {} {} {!r} {}'.format(algo, block_size or 0, size, mtime, checksum.encode('hex'))
+
+def tag_unpack(tag):
+	'Returns (checksum, algo, block_size, size, mtime) tuple from tag_pack() value, or None.'
+	try:
+		algo, block_size, size, mtime, checksum = tag.split()
+		return checksum.decode('hex'), algo, int(block_size) or None, int(size), float(mtime)
+	except (AttributeError, ValueError, TypeError): return